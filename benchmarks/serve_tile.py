@@ -0,0 +1,97 @@
+"""
+Compare the memory and CPU cost of serving tiles through the old
+``send_file(BytesIO(...))`` path with :func:`cartographer.web.serve_tile`.
+
+Usage: python benchmarks/serve_tile.py [--requests N] [--size BYTES]
+"""
+
+import argparse
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+import flask
+
+from cartographer import web
+from cartographer.mbtiles import Tileset
+
+
+def legacy_serve_tile(name, zoom, row, col):
+    try:
+        tile, tileset = web.find_tile(name, zoom, row, col)
+    except KeyError:
+        flask.abort(404)
+    else:
+        stream = io.BytesIO(tile)
+        return flask.send_file(stream, mimetype=tileset.mime_type)
+
+
+def create_tileset(directory, size, count):
+    tileset = Tileset(os.path.join(directory, 'bench.mbtiles'), create=True)
+    tileset.name = 'bench'
+    tileset.format = 'png'
+
+    zoom = 10
+    for i in range(count):
+        tileset[(zoom, i, 0)] = os.urandom(size)
+
+    return zoom
+
+
+def run(client, url_prefix, zoom, requests, count):
+    ncol = (2 ** zoom) - 1
+
+    for i in range(requests):
+        response = client.get('{}/bench/{}/{}/{}'.format(url_prefix, zoom,
+                                                          i % count, ncol),
+                              buffered=False)
+        assert response.status_code == 200
+        for chunk in response.response:
+            pass
+        response.close()
+
+
+def measure(client, url_prefix, zoom, requests, count):
+    start = time.process_time()
+    run(client, url_prefix, zoom, requests, count)
+    cpu = time.process_time() - start
+
+    tracemalloc.start()
+    run(client, url_prefix, zoom, requests, count)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return cpu, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=512 * 1024)
+    parser.add_argument('--tiles', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        zoom = create_tileset(directory, args.size, args.tiles)
+
+        web.app.config['TILES_PATH'] = directory
+
+        # Measure reading tiles, not cache hits.
+        web.app.config['TILE_CACHE_SIZE'] = 0
+        web.app.add_url_rule('/legacy/<name>/<int:zoom>/<int:row>/<int:col>',
+                             'legacy_serve_tile', legacy_serve_tile)
+
+        client = web.app.test_client()
+
+        for label, prefix in [('send_file', '/legacy'), ('serve_tile', '')]:
+            run(client, prefix, zoom, 10, args.tiles)
+            cpu, peak = measure(client, prefix, zoom, args.requests,
+                                args.tiles)
+            print('{:>10}: {:.3f}s CPU, {:.1f} KiB peak memory per {} '
+                  'requests'.format(label, cpu, peak / 1024, args.requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 import argparse
 from pathlib import Path
+import sys
+import time
 
-from . import boundaries, importers
-from .mbtiles import Tileset
+from . import boundaries
+from .mbtiles import open_tileset, Tileset
 
 
 def create_tileset(subparsers):
@@ -10,7 +12,13 @@ def create_tileset(subparsers):
         if args.description is None:
             args.description = args.name
 
-        tileset = Tileset(args.filename, create=True)
+        if args.shard_zoom is not None:
+            from .sharding import ShardedTileset
+            tileset = ShardedTileset(args.filename, create=True,
+                                     shard_zoom=args.shard_zoom)
+        else:
+            tileset = Tileset(args.filename, create=True)
+
         tileset.name = args.name
         tileset.type = args.type
         tileset.version = args.version
@@ -24,12 +32,22 @@ def create_tileset(subparsers):
     parser.add_argument('--version', '-v', type=int, default=0)
     parser.add_argument('--description', '-d', default=None)
     parser.add_argument('--format', '-f', default='png')
+    parser.add_argument('--shard-zoom', type=int, default=None)
+    parser.set_defaults(func=func)
+
+
+def upgrade_tileset(subparsers):
+    def func(args):
+        open_tileset(args.filename, upgrade=True)
+
+    parser = subparsers.add_parser('upgrade-tileset')
+    parser.add_argument('filename')
     parser.set_defaults(func=func)
 
 
 def set_metadata(subparsers):
     def func(args):
-        tileset = Tileset(args.filename)
+        tileset = open_tileset(args.filename)
         tileset.metadata[args.name] = args.value
 
     parser = subparsers.add_parser('set-metadata')
@@ -41,7 +59,7 @@ def set_metadata(subparsers):
 
 def set_boundary(subparsers):
     def func(args):
-        tileset = Tileset(args.filename)
+        tileset = open_tileset(args.filename)
         boundary = getattr(boundaries, args.boundary)
         tileset.boundary = boundary
 
@@ -51,41 +69,64 @@ def set_boundary(subparsers):
     parser.set_defaults(func=func)
 
 
+def get_importer(url):
+    from . import importers
+
+    if url == 'osm':
+        return importers.OpenStreetMap()
+    elif url == 'satellite':
+        return importers.Satellite()
+    elif url == 'mapquest':
+        return importers.MapQuest()
+    elif url.startswith('os:'):
+        key = url[3:]
+        print(key)
+        return importers.OrdnanceSurvey(key)
+    else:
+        return importers.Importer(url)
+
+
 def import_tiles(subparsers):
     def func(args):
-        tileset = Tileset(args.filename)
-
-        if args.url == 'osm':
-            importer = importers.OpenStreetMap()
-        elif args.url == 'satellite':
-            importer = importers.Satellite()
-        elif args.url == 'mapquest':
-            importer = importers.MapQuest()
-        elif args.url.startswith('os:'):
-            key = args.url[3:]
-            print(key)
-            importer = importers.OrdnanceSurvey(key)
-        else:
-            importer = importers.Importer(args.url)
+        tileset = open_tileset(args.filename, wal=args.wal)
+
+        from . import importers
+
+        importer = get_importer(args.url)
+
+        if args.fallback:
+            importer = importers.FallbackImporter(
+                [importer] + [get_importer(url) for url in args.fallback]
+            )
 
         boundary = None
         if args.boundary:
             boundary = getattr(boundaries, args.boundary)
 
         for zoom in args.zoom_level:
-            importer(tileset, zoom, boundary)
+            importer(tileset, zoom, boundary, workers=args.workers)
+
+        if args.fallback:
+            for source, count in tileset.sources.counts().items():
+                print('{}: {} tiles'.format(source, count))
+
+        tileset.compact(vacuum=args.vacuum)
 
     parser = subparsers.add_parser('import-tiles')
     parser.add_argument('filename')
     parser.add_argument('url')
     parser.add_argument('zoom_level', type=int, nargs='+')
     parser.add_argument('--boundary')
+    parser.add_argument('--fallback', action='append')
+    parser.add_argument('--workers', '-w', type=int, default=1)
+    parser.add_argument('--wal', action='store_true')
+    parser.add_argument('--vacuum', action='store_true')
     parser.set_defaults(func=func)
 
 
 def extract_tile(subparsers):
     def func(args):
-        tileset = Tileset(args.filename)
+        tileset = open_tileset(args.filename)
 
         tile = tileset.tiles[(args.zoom_level, args.row, args.col)]
 
@@ -102,7 +143,7 @@ def extract_tile(subparsers):
 
 def extract_all(subparsers):
     def func(args):
-        tileset = Tileset(args.filename)
+        tileset = open_tileset(args.filename)
 
         for zoom_level, col, row, data in tileset:
             path = Path(args.target) / str(zoom_level) / str(col)
@@ -126,34 +167,272 @@ def extract_all(subparsers):
     parser.set_defaults(func=func)
 
 
+def subset(subparsers):
+    def func(args):
+        from .subset import subset, DedupingCompressor
+
+        if args.dedupe and not args.compress:
+            parser.error('--dedupe requires --compress')
+
+        if args.min_zoom > args.max_zoom:
+            parser.error('min_zoom is greater than max_zoom')
+
+        tileset = open_tileset(args.filename)
+
+        if args.bbox:
+            tokens = [float(token) for token in args.bbox.split(',')]
+            boundary = boundaries.Boundary(*tokens)
+        elif args.boundary:
+            boundary = getattr(boundaries, args.boundary)
+        else:
+            boundary = tileset.boundary
+
+        compressor = None
+        if args.compress:
+            from . import compressors
+            if tileset.format == 'png':
+                compressor = compressors.Pngquant()
+            else:
+                compressor = compressors.Jpegoptim()
+
+            if args.dedupe:
+                compressor = DedupingCompressor(compressor)
+
+        zoom_levels = range(args.min_zoom, args.max_zoom + 1)
+        count = subset(tileset, args.target, boundary, zoom_levels,
+                       compressor)
+
+        print('Wrote {} tiles.'.format(count))
+
+    parser = subparsers.add_parser('subset')
+    parser.add_argument('filename')
+    parser.add_argument('target')
+    parser.add_argument('min_zoom', type=int)
+    parser.add_argument('max_zoom', type=int)
+    parser.add_argument('--boundary')
+    parser.add_argument('--bbox')
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--dedupe', action='store_true')
+    parser.set_defaults(func=func)
+
+
+def verify(subparsers):
+    def func(args):
+        import hashlib
+        from .sharding import ShardedTileset
+        from .verify import delete_tiles, Refetcher, Verifier
+
+        tileset = open_tileset(args.filename)
+        format = tileset.format
+
+        if isinstance(tileset, ShardedTileset):
+            tilesets = [tileset.shard(name)
+                        for name in tileset.shard_names()]
+        elif isinstance(tileset, Tileset):
+            tilesets = [tileset]
+        else:
+            sys.exit('Only MBTiles tilesets can be verified.')
+
+        bad_digests = [digest.lower() for digest in args.bad_digest or []]
+        for filename in args.bad_tile or []:
+            with open(filename, 'rb') as file:
+                bad_digests.append(hashlib.sha1(file.read()).hexdigest())
+
+        repair = None
+        if args.delete:
+            repair = delete_tiles
+        elif args.refetch:
+            repair = Refetcher(get_importer(args.refetch), tileset.format)
+
+        for tileset in tilesets:
+            print('Verifying {}'.format(tileset.filename))
+
+            verifier = Verifier(tileset, format, processes=args.processes,
+                                batch_size=args.batch_size,
+                                min_size=args.min_size,
+                                bad_digests=bad_digests)
+            problems = verifier.run(repair, restart=args.restart)
+
+            print('Checked {} tiles.'.format(verifier.count))
+            for problem, count in problems.most_common():
+                print(' - {}: {}'.format(problem, count))
+
+            print('Most repeated tiles:')
+            for digest, count in verifier.digests.most_common(5):
+                print(' - {}: {}'.format(digest, count))
+
+    parser = subparsers.add_parser('verify')
+    parser.add_argument('filename')
+    parser.add_argument('--processes', '-p', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--min-size', type=int, default=100)
+    parser.add_argument('--bad-tile', action='append')
+    parser.add_argument('--bad-digest', action='append')
+    parser.add_argument('--delete', action='store_true')
+    parser.add_argument('--refetch')
+    parser.add_argument('--restart', action='store_true')
+    parser.set_defaults(func=func)
+
+
+def pack(subparsers):
+    def func(args):
+        from .packed import pack
+
+        tileset = open_tileset(args.filename)
+        tiles, blobs = pack(tileset, args.target)
+
+        print('Packed {} tiles ({} unique).'.format(tiles, blobs))
+
+    parser = subparsers.add_parser('pack')
+    parser.add_argument('filename')
+    parser.add_argument('target')
+    parser.set_defaults(func=func)
+
+
 def web(subparsers):
     def func(args):
-        from .web import app
+        from .web import app, setup
         app.config['TILES_PATH'] = args.tiles
+        app.config['PREFETCH'] = args.prefetch
+
+        if args.cache_size is None and args.prefetch:
+            args.cache_size = 64
+
+        if args.cache_size:
+            app.config['TILE_CACHE_SIZE'] = args.cache_size * 1024 * 1024
+
+        setup()
+        report_startup(args)
+
         app.run(debug=True)
 
     parser = subparsers.add_parser('web')
     parser.add_argument('tiles', default='tiles')
+    parser.add_argument('--prefetch', action='store_true')
+    parser.add_argument('--cache-size', type=int, default=None)
     parser.set_defaults(func=func)
 
 
+def warm(subparsers):
+    def func(args):
+        import requests
+
+        boundary = getattr(boundaries, args.boundary)
+
+        url = '{}/{}/warm'.format(args.server.rstrip('/'), args.name)
+        res = requests.post(url, data={
+            'left': boundary.left,
+            'bottom': boundary.bottom,
+            'right': boundary.right,
+            'top': boundary.top,
+            'min_zoom': args.min_zoom,
+            'max_zoom': args.max_zoom,
+        })
+        res.raise_for_status()
+
+        result = res.json()
+        print('Loaded {} tiles.'.format(result['tiles']))
+        if result['skipped']:
+            print('Skipped {} tiles.'.format(result['skipped']))
+
+    parser = subparsers.add_parser('warm')
+    parser.add_argument('server')
+    parser.add_argument('name')
+    parser.add_argument('min_zoom', type=int)
+    parser.add_argument('max_zoom', type=int)
+    parser.add_argument('--boundary', default='world')
+    parser.set_defaults(func=func)
+
+
+def fake_origin(subparsers):
+    def func(args):
+        from .origin import FakeOrigin
+        origin = FakeOrigin(args.pattern, format=args.format,
+                            latency=args.latency, jitter=args.jitter,
+                            bandwidth=args.bandwidth,
+                            throttle_rate=args.throttle_rate,
+                            error_rate=args.error_rate,
+                            reset_rate=args.reset_rate, seed=args.seed)
+        report_startup(args)
+        counts = origin.serve(args.host, args.port)
+
+        for outcome, count in sorted(counts.items()):
+            print('{}: {} requests'.format(outcome, count))
+
+    parser = subparsers.add_parser('fake-origin')
+    parser.add_argument('pattern', nargs='?',
+                        default='{zoom}/{col}/{nrow}.png')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', '-p', type=int, default=8000)
+    parser.add_argument('--format', '-f', choices=['png', 'jpg'])
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--bandwidth', type=int, default=None)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--reset-rate', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.set_defaults(func=func)
+
+
+def report_startup(args):
+    """
+    Print where the time went so far, if ``--profile-startup`` was given.
+
+    Long-running commands call this once they are ready to serve.
+    """
+
+    profiler = getattr(args, 'profiler', None)
+    if profiler is None:
+        return
+
+    import pstats
+
+    profiler.disable()
+    args.profiler = None
+
+    elapsed = time.perf_counter() - args.start_time
+    print('Startup took {:.3f}s.'.format(elapsed), file=sys.stderr)
+
+    stats = pstats.Stats(profiler, stream=sys.stderr)
+    stats.sort_stats('cumulative').print_stats(25)
+
+
 def main():
+    start_time = time.perf_counter()
+
     parser = argparse.ArgumentParser()
+    parser.add_argument('--profile-startup', action='store_true')
 
     subparsers = parser.add_subparsers(help='sub-command help')
     create_tileset(subparsers)
+    upgrade_tileset(subparsers)
     import_tiles(subparsers)
     set_metadata(subparsers)
     set_boundary(subparsers)
     extract_tile(subparsers)
     extract_all(subparsers)
+    subset(subparsers)
+    verify(subparsers)
+    pack(subparsers)
     web(subparsers)
+    warm(subparsers)
+    fake_origin(subparsers)
 
     args = parser.parse_args()
 
     try:
         func = args.func
     except AttributeError:
-        args.print_help()
-    else:
-        func(args)
+        parser.print_help()
+        return
+
+    if args.profile_startup:
+        import cProfile
+        args.start_time = start_time
+        args.profiler = cProfile.Profile()
+        args.profiler.enable()
+
+    func(args)
+
+    report_startup(args)
@@ -1,5 +1,10 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import itertools
+
 import requests
 
+from .sharding import ShardedTileset
+
 
 class Importer:
     """A tile importer."""
@@ -16,31 +21,45 @@ class Importer:
         return self.url.format(zoom=zoom, row=row, col=col, nrow=nrow,
                                ncol=ncol)
 
-    def import_tile(self, tileset, zoom, col, row, compressor=None):
-        """Import a tile into the tileset."""
-
-        key = (zoom, col, row)
+    def fetch_tile(self, zoom, col, row, compressor=None):
+        """
+        Download a tile, returning its content, or ``None`` if it could not be
+        fetched.
+        """
 
         url = self.get_tile_url(zoom, col, row)
 
         print('Importing {}x{}x{}: {}'.format(zoom, col, row, url))
 
-        res = requests.get(url)
+        try:
+            res = requests.get(url)
+        except requests.RequestException as e:
+            print('Warning. This failed: {}'.format(e))
+            return None
 
         if res.status_code == requests.codes.ok:
             if compressor is not None:
-                content = compressor.compress(res.content)
+                return compressor.compress(res.content)
             else:
-                content = res.content
-
-            tileset[key] = content
-
-            return content
+                return res.content
         else:
             print('Warning. This failed.')
 
-    def __call__(self, tileset, zoom, boundary=None, compressor=None):
-        """Run the importer on a zoom level and boundary."""
+    def store_tile(self, tileset, key, content):
+        tileset[key] = content
+
+    def import_tile(self, tileset, zoom, col, row, compressor=None):
+        """Import a tile into the tileset."""
+
+        content = self.fetch_tile(zoom, col, row, compressor)
+
+        if content is not None:
+            self.store_tile(tileset, (zoom, col, row), content)
+
+        return content
+
+    def missing_tiles(self, tileset, zoom, boundary=None):
+        """Find the tiles within the boundary not yet in the tileset."""
 
         count = 2 ** zoom
 
@@ -58,7 +77,81 @@ class Importer:
             for col in range(min_col, max_col):
                 if col not in imported_cols and \
                         boundary.contains(col, row, zoom):
-                    self.import_tile(tileset, zoom, col, row, compressor)
+                    yield zoom, col, row
+
+    def __call__(self, tileset, zoom, boundary=None, compressor=None,
+                 workers=1):
+        """
+        Run the importer on a zoom level and boundary.
+
+        Tiles are downloaded by ``workers`` threads, and written as each
+        download finishes. At most ``workers * 4`` downloads are queued at a
+        time. Writes to a sharded tileset are made by a thread per shard (see
+        :class:`ShardWriter`); otherwise they are made from the calling
+        thread.
+        """
+
+        keys = self.missing_tiles(tileset, zoom, boundary)
+
+        if workers <= 1:
+            for key in keys:
+                self.import_tile(tileset, *key, compressor=compressor)
+        elif isinstance(tileset, ShardedTileset):
+            with tileset.writer() as writer:
+                self._import_parallel(writer, keys, compressor, workers)
+        else:
+            self._import_parallel(tileset, keys, compressor, workers)
+
+    def _import_parallel(self, tileset, keys, compressor, workers):
+        def fetch(key):
+            return key, self.fetch_tile(*key, compressor=compressor)
+
+        window = workers * 4
+        pending = set()
+
+        with ThreadPoolExecutor(workers) as executor:
+            try:
+                while True:
+                    for key in itertools.islice(keys, window - len(pending)):
+                        pending.add(executor.submit(fetch, key))
+
+                    if not pending:
+                        break
+
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        key, content = future.result()
+                        if content is not None:
+                            self.store_tile(tileset, key, content)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+class FallbackImporter(Importer):
+    """
+    An importer which tries each of a list of importers in turn, so that
+    tiles missing from the primary source are filled in from the others.
+
+    The source of each tile is recorded in the tileset.
+    """
+
+    def __init__(self, importers):
+        self.importers = importers
+        self.url = importers[0].url
+        self._sources = {}
+
+    def fetch_tile(self, zoom, col, row, compressor=None):
+        for importer in self.importers:
+            content = importer.fetch_tile(zoom, col, row, compressor)
+            if content is not None:
+                self._sources[(zoom, col, row)] = importer.url
+                return content
+
+    def store_tile(self, tileset, key, content):
+        super().store_tile(tileset, key, content)
+        tileset.sources[key] = self._sources.pop(key)
 
 
 class OpenStreetMap(Importer):
@@ -1,3 +1,4 @@
+import itertools
 import os
 
 import sqlite3
@@ -5,6 +6,17 @@ import sqlite3
 from .boundaries import Boundary
 
 
+def mime_type(format):
+    """Get the MIME type for a tile format."""
+
+    if format == 'png':
+        return 'image/png'
+    elif format == 'jpg':
+        return 'image/jpeg'
+    else:
+        raise ValueError('Unsupported format.')
+
+
 class TilesetMetadata:
     KNOWN_KEYS = ['name', 'type', 'version', 'description', 'format',
                   'bounds', 'attribution']
@@ -43,6 +55,11 @@ class TilesetMetadata:
             raise KeyError(name)
         self.db.commit()
 
+    def items(self):
+        cursor = self.db.cursor()
+        cursor.execute('SELECT name, value FROM metadata')
+        return cursor.fetchall()
+
 
 class TilesetTiles:
     def __init__(self, db):
@@ -67,6 +84,35 @@ class TilesetTiles:
 
         self.db.commit()
 
+    def update(self, tiles, batch_size=1000):
+        """
+        Write many tiles, from an iterable of (zoom, col, row, data) tuples,
+        committing once per batch. Existing tiles are replaced, which relies
+        on the tile index (see :meth:`TilesetSchema.upgrade`).
+
+        Returns the number of tiles written.
+        """
+
+        tiles = iter(tiles)
+        count = 0
+
+        while True:
+            batch = list(itertools.islice(tiles, batch_size))
+            if not batch:
+                break
+
+            cursor = self.db.cursor()
+            cursor.executemany("""
+                INSERT OR REPLACE INTO
+                    tiles (zoom_level, tile_column, tile_row, tile_data)
+                VALUES (?, ?, ?, ?)
+            """, batch)
+
+            self.db.commit()
+            count += len(batch)
+
+        return count
+
     def __getitem__(self, key):
         zoom, col, row = key
 
@@ -83,6 +129,112 @@ class TilesetTiles:
         else:
             return row[0]
 
+    def lookup(self, key, inline_limit=None):
+        """
+        Find a tile, returning a tuple of (rowid, length, data).
+
+        ``data`` is ``None`` if the tile is larger than ``inline_limit`` bytes,
+        in which case it can be read incrementally with :meth:`open_blob`.
+        """
+
+        zoom, col, row = key
+
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT rowid, length(tile_data), CASE
+                WHEN ? IS NULL OR length(tile_data) <= ? THEN tile_data
+            END
+            FROM tiles
+            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?
+        """, (inline_limit, inline_limit, zoom, col, row))
+
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(key)
+        else:
+            return row
+
+    def open_blob(self, rowid):
+        """Open a tile for incremental reading, as found by :meth:`lookup`."""
+
+        return self.db.blobopen('tiles', 'tile_data', rowid, readonly=True)
+
+    @staticmethod
+    def _get_many_sql(count):
+        # Row-value IN (VALUES ...) is not matched against the index, so the
+        # keys are joined to the tiles instead. CROSS JOIN keeps the keys as
+        # the outer loop, giving one index search per key.
+        return """
+            SELECT zoom_level, tile_column, tile_row, tile_data
+            FROM (VALUES {}) AS keys
+            CROSS JOIN tiles
+                ON zoom_level = keys.column1
+                AND tile_column = keys.column2
+                AND tile_row = keys.column3
+        """.format(', '.join(['(?, ?, ?)'] * count))
+
+    def get_many(self, keys, batch_size=256):
+        """
+        Get several tiles, yielding tuples of (key, data) in the same order as
+        ``keys``. ``data`` is ``None`` for tiles which do not exist.
+
+        Tiles are fetched ``batch_size`` at a time, with one query per batch.
+        """
+
+        keys = iter(keys)
+
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch:
+                break
+
+            args = [value for key in batch for value in key]
+
+            cursor = self.db.cursor()
+            cursor.execute(self._get_many_sql(len(batch)), args)
+
+            found = {(zoom, col, row): data
+                     for zoom, col, row, data in cursor}
+
+            for key in batch:
+                yield key, found.get(tuple(key))
+
+    def get_range(self, zoom, col_range, row_range):
+        """
+        Get every tile within a rectangle on one zoom level, yielding tuples
+        of (zoom, col, row, data) ordered by column and then row.
+
+        The column and row ranges are :class:`range` objects.
+        """
+
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT zoom_level, tile_column, tile_row, tile_data
+            FROM tiles
+            WHERE zoom_level = ?
+                AND tile_column >= ? AND tile_column < ?
+                AND tile_row >= ? AND tile_row < ?
+            ORDER BY tile_column, tile_row
+        """, (zoom, col_range.start, col_range.stop, row_range.start,
+              row_range.stop))
+
+        yield from cursor
+
+    def count_range(self, zoom, col_range, row_range):
+        """Count the tiles within a rectangle on one zoom level."""
+
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM tiles
+            WHERE zoom_level = ?
+                AND tile_column >= ? AND tile_column < ?
+                AND tile_row >= ? AND tile_row < ?
+        """, (zoom, col_range.start, col_range.stop, row_range.start,
+              row_range.stop))
+
+        return cursor.fetchone()[0]
+
     def __contains__(self, key):
         zoom, col, row = key
 
@@ -144,11 +296,39 @@ class TilesetTiles:
 
         yield from cursor
 
+    def _has_zoom_index(self):
+        cursor = self.db.cursor()
+        cursor.execute('PRAGMA index_list(tiles)')
+
+        for index in cursor.fetchall():
+            cursor.execute('PRAGMA index_info({})'.format(index[1]))
+            columns = cursor.fetchall()
+            if columns and columns[0][2] == 'zoom_level':
+                return True
+
+        return False
+
     @property
     def zoom_levels(self):
         cursor = self.db.cursor()
-        cursor.execute('SELECT DISTINCT zoom_level FROM tiles')
-        return [row[0] for row in cursor.fetchall()]
+
+        if not self._has_zoom_index():
+            cursor.execute('SELECT DISTINCT zoom_level FROM tiles')
+            return sorted(row[0] for row in cursor.fetchall())
+
+        # Jump from one zoom level to the next using the index, rather than
+        # reading every row.
+        zoom_levels = []
+        cursor.execute('SELECT MIN(zoom_level) FROM tiles')
+        zoom = cursor.fetchone()[0]
+
+        while zoom is not None:
+            zoom_levels.append(zoom)
+            cursor.execute('SELECT MIN(zoom_level) FROM tiles '
+                           'WHERE zoom_level > ?', (zoom,))
+            zoom = cursor.fetchone()[0]
+
+        return zoom_levels
 
     def _get_row(self, tile_row, zoom_level):
         cursor = self.db.cursor()
@@ -163,6 +343,81 @@ class TilesetTiles:
         return columns
 
 
+class TilesetSources:
+    """
+    Records which source each tile was imported from.
+
+    This is not part of the MBTiles specification, so the table is only
+    created when it is first written to.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def _exists(self):
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM sqlite_master
+            WHERE type = 'table' AND name = 'tile_sources'
+        """)
+        return cursor.fetchone()[0] > 0
+
+    def __setitem__(self, key, source):
+        zoom, col, row = key
+
+        cursor = self.db.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tile_sources (
+                zoom_level INTEGER,
+                tile_column INTEGER,
+                tile_row INTEGER,
+                source TEXT,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            )
+        """)
+        cursor.execute("""
+            INSERT OR REPLACE INTO
+                tile_sources (zoom_level, tile_column, tile_row, source)
+            VALUES (?, ?, ?, ?)
+        """, (zoom, col, row, source))
+
+        self.db.commit()
+
+    def __getitem__(self, key):
+        zoom, col, row = key
+
+        if not self._exists():
+            raise KeyError(key)
+
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT source
+            FROM tile_sources
+            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?
+        """, (zoom, col, row))
+
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(key)
+        else:
+            return row[0]
+
+    def counts(self):
+        """Count the number of tiles imported from each source."""
+
+        if not self._exists():
+            return {}
+
+        cursor = self.db.cursor()
+        cursor.execute("""
+            SELECT source, COUNT(*)
+            FROM tile_sources
+            GROUP BY source
+        """)
+        return dict(cursor.fetchall())
+
+
 class TilesetSchema:
     def __init__(self, db):
         self.db = db
@@ -191,29 +446,108 @@ class TilesetSchema:
             );
         """)
 
+    @staticmethod
+    def _create_tiles_index(cursor):
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS tile_index
+            ON tiles (zoom_level, tile_column, tile_row);
+        """)
+
     def create(self):
         cursor = self.db.cursor()
 
         self._create_metadata_table(cursor)
         self._create_tiles_table(cursor)
+        self._create_tiles_index(cursor)
+
+        self.db.commit()
+
+    def upgrade(self):
+        """Bring an existing tileset up to date, by adding missing indexes."""
+
+        cursor = self.db.cursor()
+
+        self._create_tiles_index(cursor)
 
         self.db.commit()
 
 
 class Tileset:
-    def __init__(self, filename, create=False, upgrade=False):
+    def __init__(self, filename, create=False, upgrade=False, wal=False,
+                 timeout=5.0, check_same_thread=True):
         if not create and not os.path.exists(filename):
             raise ValueError('Tileset does not exist: {}'.format(filename))
 
-        self.db = sqlite3.connect(filename)
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=timeout,
+                                  check_same_thread=check_same_thread)
 
         self.schema = TilesetSchema(self.db)
 
         if create:
             self.schema.create()
+        elif upgrade:
+            self.schema.upgrade()
+
+        if wal:
+            self.enable_wal()
 
         self.metadata = TilesetMetadata(self.db)
         self.tiles = TilesetTiles(self.db)
+        self.sources = TilesetSources(self.db)
+
+    def enable_wal(self, synchronous='NORMAL', cache_size=-65536,
+                   autocheckpoint=10000):
+        """
+        Switch the tileset to write-ahead logging, so that readers are not
+        blocked by a long-running import.
+
+        A negative ``cache_size`` is in KiB, ``autocheckpoint`` is in pages.
+        """
+
+        cursor = self.db.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        if cursor.fetchone()[0].lower() != 'wal':
+            raise ValueError('Unable to enable WAL journaling.')
+
+        cursor.execute('PRAGMA synchronous = {}'.format(synchronous))
+        cursor.execute('PRAGMA cache_size = {:d}'.format(cache_size))
+        cursor.execute('PRAGMA wal_autocheckpoint = {:d}'
+                       .format(autocheckpoint))
+
+    @property
+    def journal_mode(self):
+        cursor = self.db.cursor()
+        cursor.execute('PRAGMA journal_mode')
+        return cursor.fetchone()[0]
+
+    def checkpoint(self, mode='PASSIVE'):
+        """
+        Copy the write-ahead log back into the database file.
+
+        Returns a tuple of (busy, log pages, checkpointed pages).
+        """
+
+        cursor = self.db.cursor()
+        cursor.execute('PRAGMA wal_checkpoint({})'.format(mode))
+        return tuple(cursor.fetchone())
+
+    def compact(self, vacuum=False):
+        """
+        Tidy up the database once an import has finished: checkpoint and
+        truncate the write-ahead log, refresh the query planner statistics and
+        optionally rebuild the file to reclaim free pages.
+        """
+
+        self.db.commit()
+
+        if vacuum:
+            self.db.execute('VACUUM')
+
+        self.db.execute('PRAGMA optimize')
+
+        if self.journal_mode.lower() == 'wal':
+            self.checkpoint('TRUNCATE')
 
     @property
     def boundary(self):
@@ -226,12 +560,7 @@ class Tileset:
 
     @property
     def mime_type(self):
-        if self.format == 'png':
-            return 'image/png'
-        elif self.format == 'jpg':
-            return 'image/jpeg'
-        else:
-            raise ValueError('Unsupported format.')
+        return mime_type(self.format)
 
     @property
     def zoom_levels(self):
@@ -273,3 +602,16 @@ class Tileset:
 
     def __iter__(self):
         yield from self.tiles.all()
+
+
+def open_tileset(filename, **kwargs):
+    """Open a single-file, sharded or packed tileset."""
+
+    if os.path.isdir(filename):
+        from .sharding import ShardedTileset
+        return ShardedTileset(filename, **kwargs)
+    elif filename.endswith('.pack'):
+        from .packed import PackedTileset
+        return PackedTileset(filename)
+    else:
+        return Tileset(filename, **kwargs)
@@ -0,0 +1,295 @@
+"""A local stand-in for a remote tile server, used for testing importers."""
+
+import functools
+import hashlib
+import http.server
+import logging
+import random
+import re
+import socket
+import socketserver
+import string
+import struct
+import threading
+import time
+import zlib
+
+from .mbtiles import mime_type
+
+
+logger = logging.getLogger(__name__)
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+JPEG_TEMPLATE = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x01\x00H\x00H\x00' \
+                b'\x00\xff\xfe\x00\x13Created with GIMP\xff\xdb\x00C\x00\x01' \
+                b'\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01' \
+                b'\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01' \
+                b'\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01' \
+                b'\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01' \
+                b'\x01\x01\x01\x01\x01\x01\x01\xff\xdb\x00C\x01\x01\x01\x01' \
+                b'\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01' \
+                b'\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01' \
+                b'\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01' \
+                b'\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01' \
+                b'\x01\x01\x01\x01\x01\xff\xc2\x00\x11\x08\x00\x02\x00\x02' \
+                b'\x03\x01\x11\x00\x02\x11\x01\x03\x11\x01\xff\xc4\x00\x14' \
+                b'\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' \
+                b'\x00\x00\x00\t\xff\xc4\x00\x14\x01\x01\x00\x00\x00\x00\x00' \
+                b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xda\x00' \
+                b'\x0c\x03\x01\x00\x02\x10\x03\x10\x00\x00\x017\x8f\xff\xc4' \
+                b'\x00\x16\x10\x01\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00' \
+                b'\x00\x00\x00\x00\x00\x06\x07\x05\xff\xda\x00\x08\x01\x01' \
+                b'\x00\x01\x05\x02\xa1P\x9f`\xbe\xff\xc4\x00\x14\x11\x01\x00' \
+                b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' \
+                b'\x00\xff\xda\x00\x08\x01\x03\x01\x01?\x01\x7f\xff\xc4\x00' \
+                b'\x14\x11\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' \
+                b'\x00\x00\x00\x00\x00\xff\xda\x00\x08\x01\x02\x01\x01?\x01' \
+                b'\x7f\xff\xc4\x00\x19\x10\x00\x03\x01\x01\x01\x00\x00\x00' \
+                b'\x00\x00\x00\x00\x00\x00\x00\x00\x03\x04\x05\x06\x02\x01' \
+                b'\xff\xda\x00\x08\x01\x01\x00\x06?\x02\xdcB\x85\xb8\xd7\xc5' \
+                b'\x89\x17_\xa5\x93\x1e<\x9d-\xa9\xd2\xe4\xcb\x9di\xd4\xe7' \
+                b'\xcd\x9b=7B\xa23\xd1P"U4\xd5\x10\x97Yq\x0c!\x1f\x03\xe3\x9e' \
+                b'|\xff\xc4\x00\x14\x10\x01\x00\x00\x00\x00\x00\x00\x00\x00' \
+                b'\x00\x00\x00\x00\x00\x00\x00\x00\xff\xda\x00\x08\x01\x01' \
+                b'\x00\x01?!\x1c#ka\xc2\x96\xbb\xfe\xff\xda\x00\x0c\x03\x01' \
+                b'\x00\x02\x00\x03\x00\x00\x00\x10\x1f\xff\xc4\x00\x14\x11' \
+                b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' \
+                b'\x00\x00\x00\xff\xda\x00\x08\x01\x03\x01\x01?\x10\x7f\xff' \
+                b'\xc4\x00\x14\x11\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00' \
+                b'\x00\x00\x00\x00\x00\x00\x00\xff\xda\x00\x08\x01\x02\x01' \
+                b'\x01?\x10\x7f\xff\xc4\x00\x14\x10\x01\x00\x00\x00\x00\x00' \
+                b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xda\x00' \
+                b'\x08\x01\x01\x00\x01?\x10jj\x01K\x96\xd9\xfd\x91\xff\xd9'
+
+FIELD_PATTERNS = {
+    'zoom': r'\d+',
+    'row': r'\d+',
+    'col': r'\d+',
+    'nrow': r'\d+',
+    'ncol': r'\d+',
+    'quad_key': r'[0-3]*',
+}
+
+
+def compile_pattern(pattern):
+    """
+    Convert an importer URL pattern, such as ``{zoom}/{col}/{nrow}.png``, into
+    a regular expression matching request paths.
+
+    Any scheme and host in the pattern are ignored, as are query strings.
+    """
+
+    pattern = re.sub(r'^[a-z]+://[^/]+', '', pattern).split('?')[0]
+
+    regex = ''
+    for literal, field, _, _ in string.Formatter().parse(pattern):
+        regex += re.escape(literal)
+        if field is not None:
+            regex += '(?P<{}>{})'.format(field,
+                                         FIELD_PATTERNS.get(field, r'[^/]*'))
+
+    return re.compile('^/?' + regex + '$')
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack('>I', len(data)) + chunk \
+        + struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+
+
+@functools.lru_cache(maxsize=256)
+def _png_image_data(colour, size):
+    line = b'\x00' + bytes(colour) * size
+    return zlib.compress(line * size)
+
+
+def generate_png(name, size=256):
+    """Generate a solid PNG tile whose colour and text depend on ``name``."""
+
+    colour = tuple(hashlib.md5(name.encode()).digest()[:3])
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+
+    return PNG_SIGNATURE \
+        + _png_chunk(b'IHDR', header) \
+        + _png_chunk(b'tEXt', b'Comment\x00' + name.encode()) \
+        + _png_chunk(b'IDAT', _png_image_data(colour, size)) \
+        + _png_chunk(b'IEND', b'')
+
+
+def generate_jpeg(name):
+    """Generate a tiny JPEG tile with ``name`` embedded as a comment."""
+
+    comment = name.encode()
+    segment = b'\xff\xfe' + struct.pack('>H', len(comment) + 2) + comment
+    return JPEG_TEMPLATE[:2] + segment + JPEG_TEMPLATE[2:]
+
+
+class FakeOrigin:
+    """
+    A deterministic tile origin which can inject latency, bandwidth limits,
+    rate-limiting responses, server errors and connection resets.
+
+    Rates are probabilities between 0 and 1, ``latency`` and ``jitter`` are in
+    seconds and ``bandwidth`` is in bytes per second.
+    """
+
+    def __init__(self, pattern, format=None, latency=0, jitter=0,
+                 bandwidth=None, throttle_rate=0, error_rate=0,
+                 reset_rate=0, seed=None):
+        logger.info('Initialising fake origin: %s', pattern)
+
+        if format is None:
+            format = 'jpg' if pattern.endswith(('.jpg', '.jpeg')) else 'png'
+
+        self.pattern = pattern
+        self.regex = compile_pattern(pattern)
+        self.format = format
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.counts = {'ok': 0, 'throttled': 0, 'error': 0, 'reset': 0,
+                       'not_found': 0}
+
+    @property
+    def mime_type(self):
+        return mime_type(self.format)
+
+    def generate_tile(self, fields):
+        """Generate the tile for a set of matched URL fields."""
+
+        name = ','.join('{}={}'.format(key, fields[key])
+                        for key in sorted(fields))
+
+        if self.format == 'jpg':
+            return generate_jpeg(name)
+        else:
+            return generate_png(name)
+
+    def choose_outcome(self):
+        """Pick what should happen to the next request."""
+
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            draw = self.random.random()
+
+        if draw < self.reset_rate:
+            outcome = 'reset'
+        elif draw < self.reset_rate + self.throttle_rate:
+            outcome = 'throttled'
+        elif draw < self.reset_rate + self.throttle_rate + self.error_rate:
+            outcome = 'error'
+        else:
+            outcome = 'ok'
+
+        return outcome, delay
+
+    def record(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def make_server(self, host='localhost', port=0):
+        """Create (but do not start) a HTTP server for this origin."""
+
+        class Handler(FakeOriginHandler):
+            origin = self
+
+        return FakeOriginServer((host, port), Handler)
+
+    def serve(self, host='localhost', port=8000):
+        """Serve tiles until interrupted, returning the request outcomes."""
+
+        server = self.make_server(host, port)
+        print('Serving on {}:{}'.format(*server.server_address))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+        return self.counts
+
+
+class FakeOriginServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class FakeOriginHandler(http.server.BaseHTTPRequestHandler):
+    origin = None
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        match = self.origin.regex.match(self.path.split('?')[0])
+        if match is None:
+            self.origin.record('not_found')
+            self.send_error(404)
+            return
+
+        outcome, delay = self.origin.choose_outcome()
+        self.origin.record(outcome)
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if outcome == 'reset':
+            self.reset()
+        elif outcome == 'throttled':
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif outcome == 'error':
+            with self.origin.lock:
+                code = self.origin.random.choice([500, 502, 503, 504])
+            self.send_response(code)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            tile = self.origin.generate_tile(match.groupdict())
+            self.send_response(200)
+            self.send_header('Content-Type', self.origin.mime_type)
+            self.send_header('Content-Length', str(len(tile)))
+            self.end_headers()
+            self.write_throttled(tile)
+
+    def write_throttled(self, data):
+        bandwidth = self.origin.bandwidth
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+
+        chunk_size = max(1, bandwidth // 10)
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            time.sleep(len(chunk) / bandwidth)
+
+    def reset(self):
+        """Abort the connection with a TCP reset."""
+
+        self.close_connection = True
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.connection.close()
+
+    def finish(self):
+        try:
+            super().finish()
+        except (OSError, ValueError):
+            pass
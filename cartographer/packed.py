@@ -0,0 +1,330 @@
+"""
+A compact, read-only archive format for serving tilesets.
+
+A packed tileset is a single file containing every distinct tile blob once,
+followed by the tileset metadata (as JSON) and a directory of tiles sorted by
+zoom level and then quadkey. The directory is stored as three arrays: tile
+keys, blob offsets and blob lengths. Reading memory-maps the file, so opening
+it is instant and a lookup is a binary search over the keys.
+
+The layout is::
+
+    header | blobs | metadata | keys (u64) | offsets (u64) | lengths (u32)
+
+All integers are little-endian, and the arrays are aligned to 8 bytes.
+"""
+
+import array
+import bisect
+import hashlib
+import json
+import mmap
+import struct
+import sys
+
+from .mbtiles import mime_type, TilesetMetadata
+
+
+MAGIC = b'CTPK'
+VERSION = 1
+
+# magic, version, reserved, metadata offset, metadata length, index offset,
+# tile count
+HEADER = struct.Struct('<4sHHQQQQ')
+
+
+def _spread(value):
+    value &= 0xffffffff
+    value = (value | (value << 16)) & 0x0000ffff0000ffff
+    value = (value | (value << 8)) & 0x00ff00ff00ff00ff
+    value = (value | (value << 4)) & 0x0f0f0f0f0f0f0f0f
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+
+def _compact(value):
+    value &= 0x5555555555555555
+    value = (value | (value >> 1)) & 0x3333333333333333
+    value = (value | (value >> 2)) & 0x0f0f0f0f0f0f0f0f
+    value = (value | (value >> 4)) & 0x00ff00ff00ff00ff
+    value = (value | (value >> 8)) & 0x0000ffff0000ffff
+    value = (value | (value >> 16)) & 0x00000000ffffffff
+    return value
+
+
+def tile_key(zoom, col, row):
+    """
+    Get the directory key of a tile, with ``row`` in MBTiles (TMS) order.
+
+    Keys sort by zoom level, then in quadkey order.
+    """
+
+    y = (2 ** zoom) - 1 - row
+    return (zoom << 58) | _spread(col) | (_spread(y) << 1)
+
+
+def split_tile_key(key):
+    """The inverse of :func:`tile_key`."""
+
+    zoom = key >> 58
+    key &= (1 << 58) - 1
+    col = _compact(key)
+    y = _compact(key >> 1)
+    return zoom, col, (2 ** zoom) - 1 - y
+
+
+def _pad(file, position):
+    padding = -position % 8
+    file.write(b'\0' * padding)
+    return position + padding
+
+
+def _array(typecode, values):
+    values = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def pack(tileset, filename):
+    """Write a tileset into a packed archive."""
+
+    blobs = {}
+    index = []
+    zoom_levels = set()
+
+    with open(filename, 'wb') as file:
+        file.write(b'\0' * HEADER.size)
+        position = HEADER.size
+
+        for zoom, col, row, data in tileset:
+            digest = hashlib.sha1(data).digest()
+
+            try:
+                offset = blobs[digest]
+            except KeyError:
+                offset = position
+                blobs[digest] = offset
+                file.write(data)
+                position += len(data)
+
+            index.append((tile_key(zoom, col, row), offset, len(data)))
+            zoom_levels.add(zoom)
+
+        index.sort()
+
+        metadata = dict(tileset.metadata.items())
+        if zoom_levels:
+            metadata['zoom_levels'] = ','.join(str(zoom)
+                                               for zoom in sorted(zoom_levels))
+
+        metadata_offset = _pad(file, position)
+        metadata = json.dumps(metadata).encode()
+        file.write(metadata)
+
+        index_offset = _pad(file, metadata_offset + len(metadata))
+        file.write(_array('Q', [key for key, _, _ in index]))
+        file.write(_array('Q', [offset for _, offset, _ in index]))
+        file.write(_array('I', [length for _, _, length in index]))
+
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, 0, metadata_offset,
+                               len(metadata), index_offset, len(index)))
+
+    return len(index), len(blobs)
+
+
+class PackedBlob:
+    """Incremental reading of a tile, like :class:`sqlite3.Blob`."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, length=-1):
+        if length < 0:
+            end = len(self.data)
+        else:
+            end = self.position + length
+
+        chunk = self.data[self.position:end]
+        self.position += len(chunk)
+        return bytes(chunk)
+
+    def close(self):
+        self.data.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedTilesetTiles:
+    """The read-only parts of the :class:`TilesetTiles` interface."""
+
+    def __init__(self, buffer, index_offset, count):
+        self.buffer = buffer
+
+        end = index_offset + count * 8
+        self.keys = self._cast(buffer[index_offset:end], 'Q')
+        self.offsets = self._cast(buffer[end:end + count * 8], 'Q')
+        end += count * 8
+        self.lengths = self._cast(buffer[end:end + count * 4], 'I')
+
+    @staticmethod
+    def _cast(view, typecode):
+        if sys.byteorder == 'little':
+            return view.cast(typecode)
+        else:
+            values = array.array(typecode, view)
+            values.byteswap()
+            return values
+
+    def _find(self, key):
+        tile = tile_key(*key)
+        index = bisect.bisect_left(self.keys, tile)
+        if index == len(self.keys) or self.keys[index] != tile:
+            raise KeyError(key)
+        return index
+
+    def _data(self, index):
+        offset = self.offsets[index]
+        return self.buffer[offset:offset + self.lengths[index]]
+
+    def __getitem__(self, key):
+        """Get a tile, as a :class:`memoryview` of the archive."""
+
+        return self._data(self._find(key))
+
+    def __contains__(self, key):
+        try:
+            self._find(key)
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def lookup(self, key, inline_limit=None):
+        """
+        Like :meth:`TilesetTiles.lookup`, with an index for the rowid. The
+        tile is a :class:`memoryview` of the archive, rather than a copy.
+        """
+
+        index = self._find(key)
+        length = self.lengths[index]
+
+        if inline_limit is None or length <= inline_limit:
+            return index, length, self._data(index)
+        else:
+            return index, length, None
+
+    def open_blob(self, rowid):
+        return PackedBlob(self._data(rowid))
+
+    def get_many(self, keys, batch_size=None):
+        for key in keys:
+            try:
+                yield key, bytes(self[key])
+            except KeyError:
+                yield key, None
+
+    def _find_range(self, zoom, col_range, row_range):
+        if len(col_range) == 0 or len(row_range) == 0:
+            return []
+
+        # Every tile in the rectangle lies between its two corners in quadkey
+        # order, so only that part of the directory needs to be scanned.
+        start = bisect.bisect_left(
+            self.keys, tile_key(zoom, col_range.start, row_range.stop - 1)
+        )
+        end = bisect.bisect_right(
+            self.keys, tile_key(zoom, col_range.stop - 1, row_range.start)
+        )
+
+        tiles = []
+        for index in range(start, end):
+            _, col, row = split_tile_key(self.keys[index])
+            if col in col_range and row in row_range:
+                tiles.append((col, row, index))
+        return tiles
+
+    def get_range(self, zoom, col_range, row_range):
+        for col, row, index in sorted(self._find_range(zoom, col_range,
+                                                       row_range)):
+            yield zoom, col, row, bytes(self._data(index))
+
+    def count_range(self, zoom, col_range, row_range):
+        return len(self._find_range(zoom, col_range, row_range))
+
+    def count(self, zoom=None):
+        if zoom is None:
+            return len(self.keys)
+
+        start = bisect.bisect_left(self.keys, zoom << 58)
+        end = bisect.bisect_left(self.keys, (zoom + 1) << 58)
+        return end - start
+
+    def all(self):
+        for index, key in enumerate(self.keys):
+            zoom, col, row = split_tile_key(key)
+            yield zoom, col, row, bytes(self._data(index))
+
+    @property
+    def zoom_levels(self):
+        zoom_levels = set()
+        for key in self.keys:
+            zoom_levels.add(key >> 58)
+        return sorted(zoom_levels)
+
+
+class PackedTileset:
+    """A read-only tileset backed by a memory-mapped packed archive."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, 'rb') as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buffer = memoryview(self.mmap)
+
+        magic, version, _, metadata_offset, metadata_length, index_offset, \
+            count = HEADER.unpack_from(buffer)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a packed tileset: {}'.format(filename))
+
+        metadata = buffer[metadata_offset:metadata_offset + metadata_length]
+        self.metadata = json.loads(bytes(metadata).decode())
+
+        self.tiles = PackedTilesetTiles(buffer, index_offset, count)
+
+    @property
+    def mime_type(self):
+        return mime_type(self.format)
+
+    @property
+    def zoom_levels(self):
+        if 'zoom_levels' in self.metadata:
+            zoom_levels_str = self.metadata['zoom_levels']
+            return [int(token) for token in zoom_levels_str.split(',')]
+        else:
+            return self.tiles.zoom_levels
+
+    def __getattr__(self, key):
+        if key in TilesetMetadata.KNOWN_KEYS:
+            return self.metadata[key]
+        else:
+            raise AttributeError(key)
+
+    def __getitem__(self, key):
+        return self.tiles[key]
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def __iter__(self):
+        yield from self.tiles.all()
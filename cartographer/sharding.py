@@ -0,0 +1,481 @@
+"""
+Tilesets split across several MBTiles files, for datasets too large to
+comfortably manage as a single file.
+
+A sharded tileset is a directory. Tiles below the shard zoom level, along with
+the metadata, are stored in ``base.mbtiles``. Every other tile is stored in a
+shard named after the quadkey of its ancestor at the shard zoom level, such as
+``0213.mbtiles``. Since each shard is a separate SQLite database, different
+shards can be written to at the same time, using a :class:`ShardWriter`.
+"""
+
+from collections import Counter
+import heapq
+import itertools
+import os
+import queue
+import threading
+
+from .mbtiles import Tileset
+
+
+BASE_SHARD = 'base'
+
+
+def is_sharded_tileset(path):
+    """Check whether a path is the directory of a sharded tileset."""
+
+    return os.path.isfile(os.path.join(path, BASE_SHARD + '.mbtiles'))
+
+
+def quadkey(zoom, col, row):
+    """Get the quadkey of a tile, with ``row`` in MBTiles (TMS) order."""
+
+    row = (2 ** zoom) - 1 - row
+
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digit = 0
+        if col & mask:
+            digit += 1
+        if row & mask:
+            digit += 2
+        digits.append(str(digit))
+
+    return ''.join(digits)
+
+
+class ShardedTilesetTiles:
+    """The same interface as :class:`TilesetTiles`, routed to each shard."""
+
+    def __init__(self, tileset):
+        self.tileset = tileset
+
+    def _shard(self, key, create=False):
+        return self.tileset.shard_for(key, create).tiles
+
+    def __setitem__(self, key, value):
+        self._shard(key, create=True)[key] = value
+
+    def __getitem__(self, key):
+        try:
+            tiles = self._shard(key)
+        except KeyError:
+            raise KeyError(key)
+
+        return tiles[key]
+
+    def lookup(self, key, inline_limit=None):
+        """
+        Like :meth:`TilesetTiles.lookup`, but the returned rowid is a tuple of
+        (shard name, rowid).
+        """
+
+        name = self.tileset.shard_name(key)
+
+        try:
+            tiles = self.tileset.shard(name).tiles
+        except KeyError:
+            raise KeyError(key)
+
+        rowid, length, data = tiles.lookup(key, inline_limit)
+        return (name, rowid), length, data
+
+    def open_blob(self, rowid):
+        name, rowid = rowid
+        return self.tileset.shard(name).tiles.open_blob(rowid)
+
+    def update(self, tiles, batch_size=1000):
+        tiles = iter(tiles)
+        count = 0
+
+        while True:
+            batch = list(itertools.islice(tiles, batch_size))
+            if not batch:
+                break
+
+            by_shard = {}
+            for tile in batch:
+                by_shard.setdefault(self.tileset.shard_name(tile[:3]), []) \
+                    .append(tile)
+
+            for name, shard_tiles in by_shard.items():
+                shard = self.tileset.shard(name, create=True)
+                count += shard.tiles.update(shard_tiles, batch_size)
+
+        return count
+
+    def get_many(self, keys, batch_size=256):
+        keys = iter(keys)
+
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch:
+                break
+
+            by_shard = {}
+            for key in batch:
+                by_shard.setdefault(self.tileset.shard_name(key), []) \
+                    .append(key)
+
+            found = {}
+            for name, shard_keys in by_shard.items():
+                try:
+                    tiles = self.tileset.shard(name).tiles
+                except KeyError:
+                    continue
+                found.update(tiles.get_many(shard_keys, batch_size))
+
+            for key in batch:
+                yield key, found.get(key)
+
+    def _range_shards(self, zoom, col_range, row_range):
+        shard_zoom = self.tileset.shard_zoom
+
+        if zoom < shard_zoom:
+            return self._named_shards([BASE_SHARD])
+
+        shift = zoom - shard_zoom
+        return self._named_shards(
+            quadkey(shard_zoom, col, row)
+            for col in range(col_range.start >> shift,
+                             ((col_range.stop - 1) >> shift) + 1)
+            for row in range(row_range.start >> shift,
+                             ((row_range.stop - 1) >> shift) + 1)
+        )
+
+    def get_range(self, zoom, col_range, row_range):
+        shards = self._range_shards(zoom, col_range, row_range)
+
+        yield from heapq.merge(
+            *[tiles.get_range(zoom, col_range, row_range)
+              for tiles in shards],
+            key=lambda tile: tile[1:3]
+        )
+
+    def count_range(self, zoom, col_range, row_range):
+        return sum(tiles.count_range(zoom, col_range, row_range)
+                   for tiles in self._range_shards(zoom, col_range,
+                                                   row_range))
+
+    def __contains__(self, key):
+        try:
+            tiles = self._shard(key)
+        except KeyError:
+            return False
+
+        return key in tiles
+
+    def __delitem__(self, key):
+        try:
+            tiles = self._shard(key)
+        except KeyError:
+            raise KeyError(key)
+
+        del tiles[key]
+
+    def _named_shards(self, names):
+        for name in names:
+            try:
+                yield self.tileset.shard(name).tiles
+            except KeyError:
+                pass
+
+    def _shards(self, zoom=None):
+        if zoom is None or zoom < self.tileset.shard_zoom:
+            names = [BASE_SHARD]
+        else:
+            names = []
+
+        if zoom is None or zoom >= self.tileset.shard_zoom:
+            names += [name for name in self.tileset.shard_names()
+                      if name != BASE_SHARD]
+
+        return self._named_shards(names)
+
+    def count(self, zoom=None, col=None, row=None):
+        return sum(tiles.count(zoom, col, row)
+                   for tiles in self._shards(zoom))
+
+    def all(self):
+        for tiles in self._shards():
+            yield from tiles.all()
+
+    @property
+    def zoom_levels(self):
+        zoom_levels = set()
+        for tiles in self._shards():
+            zoom_levels.update(tiles.zoom_levels)
+        return sorted(zoom_levels)
+
+    def _get_row(self, tile_row, zoom_level):
+        if zoom_level < self.tileset.shard_zoom:
+            shards = self._shards(zoom_level)
+        else:
+            shard_zoom = self.tileset.shard_zoom
+            shard_row = tile_row >> (zoom_level - shard_zoom)
+            shards = self._named_shards(
+                quadkey(shard_zoom, col, shard_row)
+                for col in range(2 ** shard_zoom)
+            )
+
+        columns = []
+        for tiles in shards:
+            columns += tiles._get_row(tile_row, zoom_level)
+        return columns
+
+
+class ShardedTilesetSources:
+    def __init__(self, tileset):
+        self.tileset = tileset
+
+    def __setitem__(self, key, source):
+        self.tileset.shard_for(key, create=True).sources[key] = source
+
+    def __getitem__(self, key):
+        return self.tileset.shard_for(key).sources[key]
+
+    def counts(self):
+        counts = Counter()
+        for name in self.tileset.shard_names():
+            counts.update(self.tileset.shard(name).sources.counts())
+        return dict(counts)
+
+
+class ShardWriter:
+    """
+    Writes tiles into a sharded tileset with one thread per shard, each with
+    its own connection, so that shards are written in parallel.
+
+    Tiles and sources are assigned as they would be on the tileset itself,
+    and are written in batches of up to ``batch_size``. Use as a context
+    manager; leaving it waits for every write to finish.
+    """
+
+    def __init__(self, tileset, batch_size=1000, queue_size=4096):
+        self.tileset = tileset
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+        self.sources = ShardWriterSources(self)
+
+        self.queues = {}
+        self.threads = []
+        self.errors = []
+
+    def _queue(self, key):
+        name = self.tileset.shard_name(key)
+
+        try:
+            return self.queues[name]
+        except KeyError:
+            pass
+
+        # Create the shard here, so that nothing sees a half-created file.
+        filename = self.tileset.shard(name, create=True).filename
+
+        items = queue.Queue(self.queue_size)
+        thread = threading.Thread(target=self._write, args=(filename, items),
+                                  daemon=True)
+        thread.start()
+
+        self.queues[name] = items
+        self.threads.append(thread)
+        return items
+
+    def _put(self, key, kind, value):
+        if self.errors:
+            raise self.errors[0]
+
+        self._queue(key).put((kind, key, value))
+
+    def __setitem__(self, key, value):
+        self._put(key, 'tile', value)
+
+    def _write(self, filename, items):
+        shard = Tileset(filename, **self.tileset.options)
+        done = False
+
+        try:
+            while not done:
+                batch = [items.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(items.get_nowait())
+                    except queue.Empty:
+                        break
+
+                if batch[-1] is None:
+                    batch.pop()
+                    done = True
+
+                shard.tiles.update(key + (value,)
+                                   for kind, key, value in batch
+                                   if kind == 'tile')
+
+                for kind, key, value in batch:
+                    if kind == 'source':
+                        shard.sources[key] = value
+        except Exception as e:
+            self.errors.append(e)
+
+            # Keep draining, so that writers never block on a full queue.
+            while not done:
+                done = items.get() is None
+        finally:
+            shard.db.close()
+
+    def close(self):
+        """Wait for every write to finish."""
+
+        for items in self.queues.values():
+            items.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.queues = {}
+        self.threads = []
+
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardWriterSources:
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __setitem__(self, key, source):
+        self.writer._put(key, 'source', source)
+
+
+class ShardedTileset(Tileset):
+    """
+    A tileset stored in a directory of MBTiles shards, partitioned by zoom
+    level and quadkey prefix.
+
+    Any extra keyword arguments, such as ``wal``, are used when opening each
+    shard.
+    """
+
+    def __init__(self, directory, create=False, shard_zoom=None, **kwargs):
+        if not create and not os.path.isdir(directory):
+            raise ValueError('Tileset does not exist: {}'.format(directory))
+
+        if create:
+            if shard_zoom is None or shard_zoom < 1:
+                raise ValueError('A shard zoom level of at least 1 is '
+                                 'required.')
+
+            if is_sharded_tileset(directory):
+                raise ValueError('Tileset already exists: {}'
+                                 .format(directory))
+
+            os.makedirs(directory, exist_ok=True)
+
+        self.filename = directory
+        self.options = kwargs
+        self.shards = {}
+
+        base = self.shard(BASE_SHARD, create=create)
+
+        self.db = base.db
+        self.schema = base.schema
+        self.metadata = base.metadata
+        self.tiles = ShardedTilesetTiles(self)
+        self.sources = ShardedTilesetSources(self)
+
+        if create:
+            self.metadata['shard_zoom'] = shard_zoom
+
+        self.shard_zoom = int(self.metadata['shard_zoom'])
+
+        if kwargs.get('upgrade'):
+            self.upgrade()
+
+    def _shard_filename(self, name):
+        return os.path.join(self.filename, name + '.mbtiles')
+
+    def shard_names(self):
+        """List the names of the shards which exist."""
+
+        names = set(self.shards)
+        for filename in os.listdir(self.filename):
+            if filename.endswith('.mbtiles'):
+                names.add(filename[:-len('.mbtiles')])
+        return sorted(names, key=lambda name: (name != BASE_SHARD, name))
+
+    def shard_name(self, key):
+        """Get the name of the shard a tile belongs in."""
+
+        zoom, col, row = key
+
+        if zoom < self.shard_zoom:
+            return BASE_SHARD
+
+        shift = zoom - self.shard_zoom
+        return quadkey(self.shard_zoom, col >> shift, row >> shift)
+
+    def shard(self, name, create=False):
+        """
+        Open a shard by name, raising :class:`KeyError` if it does not exist
+        and ``create`` is false.
+        """
+
+        try:
+            return self.shards[name]
+        except KeyError:
+            pass
+
+        filename = self._shard_filename(name)
+        exists = os.path.exists(filename)
+        if not exists and not create:
+            raise KeyError(name)
+
+        tileset = Tileset(filename, create=not exists, **self.options)
+        self.shards[name] = tileset
+        return tileset
+
+    def shard_for(self, key, create=False):
+        """Open the shard a tile belongs in."""
+
+        return self.shard(self.shard_name(key), create)
+
+    def _open_shards(self):
+        for name in self.shard_names():
+            yield self.shard(name)
+
+    def upgrade(self):
+        """Add any missing indexes to every shard."""
+
+        for shard in self._open_shards():
+            shard.schema.upgrade()
+
+    def enable_wal(self, *args, **kwargs):
+        self.options['wal'] = True
+        for shard in self._open_shards():
+            shard.enable_wal(*args, **kwargs)
+
+    @property
+    def journal_mode(self):
+        return self.shard(BASE_SHARD).journal_mode
+
+    def checkpoint(self, mode='PASSIVE'):
+        results = [shard.checkpoint(mode) for shard in self._open_shards()]
+        return tuple(sum(values) for values in zip(*results))
+
+    def compact(self, vacuum=False):
+        for shard in self._open_shards():
+            shard.compact(vacuum)
+
+    def writer(self, **kwargs):
+        """Create a :class:`ShardWriter` for writing shards in parallel."""
+
+        return ShardWriter(self, **kwargs)
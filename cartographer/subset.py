@@ -0,0 +1,99 @@
+"""Cutting a region out of a tileset, for offline use."""
+
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+
+from .mbtiles import Tileset
+
+
+logger = logging.getLogger(__name__)
+
+
+# Metadata which describes the source tileset as a whole, rather than the
+# subset, and so is not copied.
+SKIPPED_METADATA = ['bounds', 'minzoom', 'maxzoom', 'zoom_levels',
+                    'shard_zoom']
+
+
+class DedupingCompressor:
+    """
+    Wraps a compressor so that identical tiles, such as empty sea, are only
+    compressed once. At most ``max_size`` results are remembered.
+    """
+
+    def __init__(self, compressor, max_size=1024):
+        self.compressor = compressor
+        self.max_size = max_size
+        self.results = OrderedDict()
+
+    def compress(self, data):
+        digest = hashlib.sha1(data).digest()
+
+        try:
+            result = self.results[digest]
+        except KeyError:
+            result = self.compressor.compress(data)
+            self.results[digest] = result
+            if len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+        else:
+            self.results.move_to_end(digest)
+
+        return result
+
+
+def subset_tiles(tileset, boundary, zoom_levels, compressor=None):
+    """
+    Yield every tile within a boundary, as (zoom, col, row, data) tuples,
+    reading each zoom level with one range query.
+    """
+
+    for zoom in zoom_levels:
+        n = 2 ** zoom
+        min_col, min_row, max_col, max_row = boundary.tile_bounds(zoom)
+
+        cols = range(max(min_col, 0), min(max_col + 1, n))
+        rows = range(max(min_row, 0), min(max_row + 1, n))
+
+        logger.info('Zoom level %s: %s columns, %s rows', zoom, len(cols),
+                    len(rows))
+
+        for _, col, row, data in tileset.tiles.get_range(zoom, cols, rows):
+            if compressor is not None:
+                data = compressor.compress(data)
+
+            yield zoom, col, row, data
+
+
+def subset(tileset, filename, boundary, zoom_levels, compressor=None,
+           batch_size=1000):
+    """
+    Write the tiles within a boundary and range of zoom levels into a new
+    tileset, returning the number of tiles written.
+    """
+
+    if os.path.exists(filename):
+        raise ValueError('Tileset already exists: {}'.format(filename))
+
+    zoom_levels = sorted(zoom_levels)
+    if not zoom_levels:
+        raise ValueError('No zoom levels to write.')
+
+    target = Tileset(filename, create=True)
+
+    for name, value in tileset.metadata.items():
+        if name not in SKIPPED_METADATA:
+            target.metadata[name] = value
+
+    target.boundary = boundary
+    target.metadata['minzoom'] = zoom_levels[0]
+    target.metadata['maxzoom'] = zoom_levels[-1]
+
+    tiles = subset_tiles(tileset, boundary, zoom_levels, compressor)
+    count = target.tiles.update(tiles, batch_size)
+
+    target.compact()
+
+    return count
@@ -0,0 +1,362 @@
+"""
+Checking the tiles in a tileset for corruption, such as truncated downloads or
+error pages saved in place of images.
+
+Tiles are scanned in ranges of rowids by a pool of processes. Progress is
+saved to a checkpoint file after each range, so an interrupted scan can carry
+on where it left off.
+"""
+
+from collections import Counter
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import struct
+import urllib.request
+import zlib
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+logger = logging.getLogger(__name__)
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# The number of samples per pixel for each PNG colour type.
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# JPEG markers which are not followed by a length.
+JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xd0, 0xd8))
+
+# JPEG start-of-frame markers.
+JPEG_FRAME_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+# Problems which are only reported, since the tile may well be fine.
+UNREPAIRED_PROBLEMS = {'too small'}
+
+
+class TileError(Exception):
+    """Raised when a tile is not a valid image."""
+
+
+def check_png(data):
+    """Check the structure, checksums and image data of a PNG."""
+
+    if not data.startswith(PNG_SIGNATURE):
+        raise TileError('bad signature')
+
+    position = len(PNG_SIGNATURE)
+    header = None
+    image_data = []
+
+    while True:
+        if position + 8 > len(data):
+            raise TileError('truncated')
+
+        length, kind = struct.unpack_from('>I4s', data, position)
+        end = position + 8 + length + 4
+        if end > len(data):
+            raise TileError('truncated')
+
+        chunk = data[position + 4:end - 4]
+        crc, = struct.unpack_from('>I', data, end - 4)
+        if zlib.crc32(chunk) & 0xffffffff != crc:
+            raise TileError('bad checksum')
+
+        if header is None and kind != b'IHDR':
+            raise TileError('missing header')
+
+        if kind == b'IHDR':
+            header = struct.unpack('>IIBBBBB', chunk[4:])
+        elif kind == b'IDAT':
+            image_data.append(chunk[4:])
+        elif kind == b'IEND':
+            break
+
+        position = end
+
+    width, height, bit_depth, colour_type, _, _, interlace = header
+
+    try:
+        decompressor = zlib.decompressobj()
+        raw = decompressor.decompress(b''.join(image_data))
+    except zlib.error:
+        raise TileError('corrupt image data')
+
+    if not decompressor.eof:
+        raise TileError('truncated image data')
+
+    if interlace == 0 and colour_type in PNG_CHANNELS:
+        bits = width * bit_depth * PNG_CHANNELS[colour_type]
+        if len(raw) != height * (1 + (bits + 7) // 8):
+            raise TileError('wrong image size')
+
+
+def check_jpeg(data):
+    """Check the segment structure of a JPEG."""
+
+    if not data.startswith(b'\xff\xd8'):
+        raise TileError('bad signature')
+
+    position = 2
+    has_frame = False
+
+    while True:
+        if position + 2 > len(data) or data[position] != 0xff:
+            raise TileError('truncated')
+
+        marker = data[position + 1]
+
+        if marker == 0xff:
+            position += 1
+            continue
+
+        if marker in JPEG_STANDALONE_MARKERS:
+            position += 2
+            continue
+
+        if position + 4 > len(data):
+            raise TileError('truncated')
+
+        length, = struct.unpack_from('>H', data, position + 2)
+
+        if marker in JPEG_FRAME_MARKERS:
+            has_frame = True
+        elif marker == 0xda:
+            break
+
+        position += 2 + length
+
+    if not has_frame:
+        raise TileError('missing frame')
+
+    if not data.rstrip(b'\0').endswith(b'\xff\xd9'):
+        raise TileError('truncated')
+
+
+def check_tile(data, format, min_size=0, bad_digests=()):
+    """
+    Check a tile, returning a description of the problem with it, or ``None``
+    if there is nothing wrong.
+    """
+
+    if not data:
+        return 'empty'
+
+    if data.lstrip()[:1] in (b'<', b'{'):
+        return 'error page'
+
+    if hashlib.sha1(data).hexdigest() in bad_digests:
+        return 'known bad tile'
+
+    try:
+        if format == 'png':
+            check_png(data)
+        elif format == 'jpg':
+            check_jpeg(data)
+
+        if Image is not None:
+            Image.open(io.BytesIO(data)).load()
+    except TileError as e:
+        return str(e)
+    except Exception as e:
+        return 'undecodable ({})'.format(e)
+
+    if len(data) < min_size:
+        return 'too small'
+
+
+def _scan(task):
+    filename, start, end, format, min_size, bad_digests = task
+
+    path = urllib.request.pathname2url(os.path.abspath(filename))
+    db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT rowid, zoom_level, tile_column, tile_row, tile_data
+        FROM tiles
+        WHERE rowid > ? AND rowid <= ?
+    """, (start, end))
+
+    count = 0
+    problems = []
+    digests = Counter()
+
+    for rowid, zoom, col, row, data in cursor:
+        count += 1
+
+        if data:
+            digests[hashlib.sha1(data).hexdigest()] += 1
+
+        problem = check_tile(data, format, min_size, bad_digests)
+        if problem is not None:
+            problems.append((rowid, (zoom, col, row), problem))
+
+    db.close()
+
+    # Only the most common digests are worth sending back, to spot repeated
+    # error images.
+    return end, count, problems, digests.most_common(10)
+
+
+class Verifier:
+    """
+    Scans a single-file tileset for bad tiles.
+
+    ``format`` defaults to the tileset's own, but must be given for a shard
+    of a sharded tileset, since only the base shard has metadata.
+
+    ``repair`` is called with the tileset and a list of (rowid, key, problem)
+    tuples for each batch of bad tiles found. Tiles which are only too small
+    are reported, but not repaired.
+    """
+
+    def __init__(self, tileset, format=None, processes=None, batch_size=10000,
+                 min_size=0, bad_digests=(), checkpoint=None):
+        if format is None:
+            format = tileset.format
+
+        self.tileset = tileset
+        self.format = format
+        self.processes = processes
+        self.batch_size = batch_size
+        self.min_size = min_size
+        self.bad_digests = frozenset(bad_digests)
+
+        if checkpoint is None:
+            checkpoint = tileset.filename + '.verify.json'
+
+        self.checkpoint = checkpoint
+
+        self.count = 0
+        self.problems = Counter()
+        self.digests = Counter()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return 0
+
+        self.count = state['count']
+        self.problems = Counter(state['problems'])
+        return state['rowid']
+
+    def _save_checkpoint(self, rowid):
+        state = {
+            'rowid': rowid,
+            'count': self.count,
+            'problems': self.problems,
+        }
+
+        with open(self.checkpoint + '.tmp', 'w') as file:
+            json.dump(state, file)
+
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+    def _tasks(self, start):
+        cursor = self.tileset.db.cursor()
+        cursor.execute('SELECT MAX(rowid) FROM tiles')
+        last = cursor.fetchone()[0] or 0
+
+        return [(self.tileset.filename, rowid, rowid + self.batch_size,
+                 self.format, self.min_size, self.bad_digests)
+                for rowid in range(start, last, self.batch_size)]
+
+    def run(self, repair=None, restart=False):
+        """
+        Scan the tileset, carrying on from the checkpoint if there is one.
+        The checkpoint is removed once the scan is complete.
+
+        Repairs are committed while the workers are still reading, which a
+        rollback journal would block, so repairing switches the tileset to
+        write-ahead logging.
+
+        Returns a :class:`Counter` of the problems found.
+        """
+
+        if repair is not None and self.tileset.journal_mode.lower() != 'wal':
+            self.tileset.enable_wal()
+
+        if restart:
+            start = 0
+        else:
+            start = self._load_checkpoint()
+            if start:
+                logger.info('Resuming from rowid %s', start)
+
+        with multiprocessing.Pool(self.processes) as pool:
+            results = pool.imap(_scan, self._tasks(start))
+
+            for end, count, problems, digests in results:
+                self.count += count
+                self.digests.update(dict(digests))
+
+                for rowid, key, problem in problems:
+                    logger.warning('%s/%s/%s: %s', *key, problem)
+                    self.problems[problem] += 1
+
+                problems = [problem for problem in problems
+                            if problem[2] not in UNREPAIRED_PROBLEMS]
+                if problems and repair is not None:
+                    repair(self.tileset, problems)
+
+                self._save_checkpoint(end)
+
+        if repair is not None:
+            self.tileset.checkpoint('TRUNCATE')
+
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+        return self.problems
+
+
+def delete_tiles(tileset, problems):
+    """A repair which deletes the bad tiles."""
+
+    cursor = tileset.db.cursor()
+    cursor.executemany('DELETE FROM tiles WHERE rowid = ?',
+                       [(rowid,) for rowid, _, _ in problems])
+    tileset.db.commit()
+
+
+class Refetcher:
+    """
+    A repair which downloads the bad tiles again using an importer, checking
+    them as tiles of the given format.
+    """
+
+    def __init__(self, importer, format):
+        self.importer = importer
+        self.format = format
+
+    def __call__(self, tileset, problems):
+        tiles = []
+
+        for rowid, key, _ in problems:
+            data = self.importer.fetch_tile(*key)
+            if data is None:
+                continue
+
+            if check_tile(data, self.format) is not None:
+                logger.warning('%s/%s/%s: still bad after refetching', *key)
+                continue
+
+            tiles.append((data, rowid))
+
+        cursor = tileset.db.cursor()
+        cursor.executemany('UPDATE tiles SET tile_data = ? WHERE rowid = ?',
+                           tiles)
+        tileset.db.commit()
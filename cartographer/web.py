@@ -1,15 +1,53 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import io
+import json
 import logging
 import os
 from pathlib import Path
+import queue
+import sqlite3
+import threading
+import time
+import zipfile
 
 import flask
 
-from .mbtiles import Tileset
+from .boundaries import Boundary
+from .mbtiles import open_tileset
+from .sharding import is_sharded_tileset
 
 app = flask.Flask(__name__)
 
+# Tiles larger than this are streamed from SQLite in chunks, rather than being
+# read into memory in one go.
+app.config['TILE_STREAM_THRESHOLD'] = 256 * 1024
+app.config['TILE_STREAM_CHUNK_SIZE'] = 64 * 1024
+
+# Recently served tiles can be kept in memory, up to this many bytes. Nothing
+# invalidates the cache, so it is off by default: tiles rewritten while the
+# server is running would be served stale until they are evicted.
+app.config['TILE_CACHE_SIZE'] = 0
+
+# The largest number of tiles which can be downloaded in one archive.
+app.config['BBOX_MAX_TILES'] = 4096
+
+# The largest number of tiles which can be read when warming the cache. Zoom
+# levels which would take a warm request past this are skipped.
+app.config['WARM_MAX_TILES'] = 16384
+
+# The name and zoom levels of each tileset are cached here, so that the server
+# can start without opening every tileset. Defaults to a file in TILES_PATH.
+app.config['TILESET_CACHE'] = None
+
+# Prefetching loads the neighbours and parent of each requested tile into the
+# cache, so it needs TILE_CACHE_SIZE to be set. The queue size and rate (in tiles per second) bound how much work it
+# can do, so it never competes with foreground requests.
+app.config['PREFETCH'] = False
+app.config['PREFETCH_QUEUE_SIZE'] = 64
+app.config['PREFETCH_RATE'] = 200
+
+BLOB_STREAMING = hasattr(sqlite3.Connection, 'blobopen')
+
 
 if 'CARTOGRAPHER_TILES_PATH' in os.environ:
     app.config['TILES_PATH'] = os.environ['CARTOGRAPHER_TILES_PATH']
@@ -61,26 +99,310 @@ HTML = """
 
 MAPS = defaultdict(list)
 
+CACHE = None
+PREFETCHER = None
+
+READY = False
+
+
+class TileCache:
+    """A thread-safe LRU cache of tiles, limited by total size in bytes."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.tiles
+
+    def get(self, key):
+        """Get a tuple of (tile, mime type), or ``None`` if not cached."""
+
+        with self.lock:
+            try:
+                value = self.tiles[key]
+            except KeyError:
+                return None
+
+            self.tiles.move_to_end(key)
+            return value
+
+    def put(self, key, tile, mime_type):
+        if len(tile) > self.max_size:
+            return
+
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+
+            self.tiles[key] = (tile, mime_type)
+            self.size += len(tile)
+
+            while self.size > self.max_size:
+                _, (evicted, _) = self.tiles.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class Prefetcher:
+    """
+    Loads the neighbours and parent of requested tiles into the cache on a
+    background thread.
+
+    Requests beyond ``queue_size`` are dropped, and at most ``rate`` tiles
+    are loaded per second.
+    """
+
+    def __init__(self, cache, queue_size=64, rate=200, inline_limit=None):
+        self.cache = cache
+        self.queue = queue.Queue(queue_size)
+        self.interval = 1 / rate
+        self.inline_limit = inline_limit
+
+        # SQLite connections can't be shared between threads, so the worker
+        # opens its own.
+        self.tilesets = {}
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, name, zoom, row, col):
+        try:
+            self.queue.put_nowait((name, zoom, row, col))
+        except queue.Full:
+            pass
+
+    @staticmethod
+    def neighbours(zoom, row, col):
+        """The surrounding ring of tiles, and the parent tile."""
+
+        count = 2 ** zoom
+
+        neighbours = set()
+
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                n_row = (row + d_row) % count
+                n_col = col + d_col
+                if 0 <= n_col < count and (n_row, n_col) != (row, col):
+                    neighbours.add((n_row, n_col))
+
+        for n_row, n_col in sorted(neighbours):
+            yield zoom, n_row, n_col
+
+        if zoom > 0:
+            yield zoom - 1, row // 2, col // 2
+
+    def _open(self, filename):
+        try:
+            return self.tilesets[filename]
+        except KeyError:
+            tileset = open_tileset(filename)
+            self.tilesets[filename] = tileset
+            return tileset
+
+    def load(self, name, zoom, row, col):
+        key = (name, zoom, row, col)
+        if key in self.cache:
+            return False
+
+        ncol = (2 ** zoom) - 1 - col
+
+        for tileset in MAPS.get((name, zoom), []):
+            tileset = self._open(tileset.filename)
+
+            try:
+                _, _, tile = tileset.tiles.lookup((zoom, row, ncol),
+                                                  self.inline_limit)
+            except KeyError:
+                continue
+
+            if tile is not None:
+                self.cache.put(key, tile, tileset.mime_type)
+
+            return True
+
+        return False
+
+    def run(self):
+        while True:
+            name, zoom, row, col = self.queue.get()
+
+            for neighbour in self.neighbours(zoom, row, col):
+                try:
+                    loaded = self.load(name, *neighbour)
+                except Exception:
+                    app.logger.exception('Failed to prefetch tile.')
+                    loaded = False
+
+                if loaded:
+                    time.sleep(self.interval)
+
 
-@app.before_first_request
 def setup_logging():
     if not app.debug:
         app.logger.addHandler(logging.StreamHandler())
         app.logger.setLevel(logging.INFO)
 
 
-@app.before_first_request
+class LazyTileset:
+    """
+    A tileset which is only opened when it is first used.
+
+    The server handles each request on a new thread, so the tileset is opened
+    once and shared between them, rather than paying for a fresh connection
+    and a cold page cache on every request. The server only reads, and SQLite
+    serialises access to a connection which is used from several threads.
+
+    ``tileset`` may be one which is already open, with ``check_same_thread``
+    turned off.
+    """
+
+    def __init__(self, filename, tileset=None):
+        self.filename = filename
+        self._tileset = tileset
+        self._lock = threading.Lock()
+        self._mime_type = None
+
+    @property
+    def is_open(self):
+        return self._tileset is not None
+
+    @property
+    def tileset(self):
+        if self._tileset is None:
+            with self._lock:
+                if self._tileset is None:
+                    app.logger.info('Opening tileset: {}'
+                                    .format(self.filename))
+                    self._tileset = open_tileset(self.filename,
+                                                 check_same_thread=False)
+        return self._tileset
+
+    @property
+    def mime_type(self):
+        if self._mime_type is None:
+            self._mime_type = self.tileset.mime_type
+        return self._mime_type
+
+    def __getattr__(self, key):
+        return getattr(self.tileset, key)
+
+    def __getitem__(self, key):
+        return self.tileset[key]
+
+    def __contains__(self, key):
+        return key in self.tileset
+
+
+def _stat(path):
+    if path.is_dir():
+        stats = [entry.stat() for entry in os.scandir(str(path))]
+    else:
+        stats = [path.stat()]
+
+        # Writes in WAL mode only reach the main file at a checkpoint.
+        wal = Path(str(path) + '-wal')
+        if wal.exists():
+            stats.append(wal.stat())
+
+    return [max([stat.st_mtime_ns for stat in stats], default=0),
+            sum(stat.st_size for stat in stats)]
+
+
+def read_tileset_cache(path):
+    try:
+        with path.open() as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_tileset_cache(path, cache):
+    try:
+        with path.open('w') as file:
+            json.dump(cache, file, indent=2, sort_keys=True)
+    except OSError as e:
+        app.logger.warning('Unable to write tileset cache: {}'.format(e))
+
+
 def load_tiles():
     path = Path(app.config['TILES_PATH'])
-    for p in path.glob('*.mbtiles'):
-        tileset = Tileset(str(p))
-        name = tileset.name
+
+    cache_path = app.config['TILESET_CACHE']
+    if cache_path is None:
+        cache_path = path / '.cartographer-cache.json'
+    else:
+        cache_path = Path(cache_path)
+
+    old_cache = read_tileset_cache(cache_path)
+    cache = {}
+
+    # Sharded tilesets are directories, which may be named anything.
+    paths = sorted(p for p in path.iterdir()
+                   if p.suffix == '.mbtiles' and p.is_file()
+                   or is_sharded_tileset(str(p)))
+    paths += sorted(path.glob('*.pack'))
+    for p in paths:
+        stat = _stat(p)
+        entry = old_cache.get(str(p))
+
+        if entry is not None and entry['stat'] == stat:
+            tileset = LazyTileset(str(p))
+        else:
+            opened = open_tileset(str(p), check_same_thread=False)
+            entry = {
+                'stat': stat,
+                'name': opened.name,
+                'zoom_levels': opened.zoom_levels,
+            }
+            tileset = LazyTileset(str(p), opened)
+
+        cache[str(p)] = entry
+        name = entry['name']
 
         app.logger.info('Registering tileset: {} ({})'.format(name, p))
-        for zoom_level in tileset.zoom_levels:
+        for zoom_level in entry['zoom_levels']:
             app.logger.info(' - Zoom level: {}'.format(zoom_level))
             MAPS[(name, zoom_level)].append(tileset)
 
+    if cache != old_cache:
+        write_tileset_cache(cache_path, cache)
+
+
+def setup_cache():
+    global CACHE, PREFETCHER
+
+    if app.config['TILE_CACHE_SIZE']:
+        CACHE = TileCache(app.config['TILE_CACHE_SIZE'])
+
+    if CACHE is not None and app.config['PREFETCH']:
+        PREFETCHER = Prefetcher(CACHE, app.config['PREFETCH_QUEUE_SIZE'],
+                                app.config['PREFETCH_RATE'],
+                                app.config['TILE_STREAM_THRESHOLD'])
+
+
+@app.before_first_request
+def setup():
+    """
+    Register the tilesets and create the cache. This happens before the first
+    request, unless it has already been called.
+    """
+
+    global READY
+
+    if READY:
+        return
+
+    setup_logging()
+    load_tiles()
+    setup_cache()
+
+    READY = True
+
 
 def find_tile(name, zoom, row, col):
     tilesets = MAPS[(name, zoom)]
@@ -95,20 +417,234 @@ def find_tile(name, zoom, row, col):
     raise KeyError('No such tile.')
 
 
+def locate_tile(name, zoom, row, col, inline_limit=None):
+    """
+    Like :func:`find_tile`, but returns the result of
+    :meth:`TilesetTiles.lookup` so that large tiles can be streamed.
+    """
+
+    tilesets = MAPS[(name, zoom)]
+    ncol = (2 ** zoom) - 1 - col
+
+    for tileset in tilesets:
+        try:
+            return tileset.tiles.lookup((zoom, row, ncol), inline_limit), \
+                tileset
+        except KeyError:
+            pass
+
+    raise KeyError('No such tile.')
+
+
+def _tile_ranges(zoom, boundary):
+    n = 2 ** zoom
+    min_row, min_ncol, max_row, max_ncol = boundary.tile_bounds(zoom)
+
+    return (range(max(min_row, 0), min(max_row + 1, n)),
+            range(max(min_ncol, 0), min(max_ncol + 1, n)))
+
+
+def count_tiles(name, zoom, boundary):
+    """
+    Count the tiles within a boundary on one zoom level, without reading
+    them. Tiles in more than one tileset are counted more than once.
+    """
+
+    rows, ncols = _tile_ranges(zoom, boundary)
+    return sum(tileset.tiles.count_range(zoom, rows, ncols)
+               for tileset in MAPS.get((name, zoom), []))
+
+
+def find_tiles(name, zoom, boundary):
+    """
+    Find every tile within a boundary on one zoom level, yielding tuples of
+    (row, col, tile, tileset) using the same coordinates as
+    :func:`find_tile`.
+    """
+
+    n = 2 ** zoom
+    rows, ncols = _tile_ranges(zoom, boundary)
+
+    found = set()
+
+    for tileset in MAPS.get((name, zoom), []):
+        for _, row, ncol, tile in tileset.tiles.get_range(zoom, rows, ncols):
+            if (row, ncol) not in found:
+                found.add((row, ncol))
+                yield row, n - 1 - ncol, tile, tileset
+
+
+def warm_cache(name, boundary, zoom_levels, max_tiles):
+    """
+    Load the tiles within a boundary into the cache, lowest zoom level first.
+
+    Zoom levels which would take the number of tiles read past ``max_tiles``
+    are skipped, and loading stops once the cache is full. Returns a tuple of
+    the number of tiles loaded and the number skipped.
+    """
+
+    loaded = 0
+    skipped = 0
+    read = 0
+    size = 0
+    full = False
+
+    for zoom in sorted(zoom_levels):
+        total = count_tiles(name, zoom, boundary)
+        if full or read + total > max_tiles:
+            skipped += total
+            continue
+
+        read += total
+        seen = 0
+
+        for row, col, tile, tileset in find_tiles(name, zoom, boundary):
+            seen += 1
+
+            key = (name, zoom, row, col)
+            if key in CACHE or len(tile) > app.config['TILE_STREAM_THRESHOLD']:
+                continue
+
+            # Anything more would only evict the tiles just loaded.
+            if size + len(tile) > CACHE.max_size:
+                full = True
+                skipped += total - seen + 1
+                break
+
+            CACHE.put(key, tile, tileset.mime_type)
+            loaded += 1
+            size += len(tile)
+
+    return loaded, skipped
+
+
+def stream_blob(tileset, rowid, chunk_size):
+    with tileset.tiles.open_blob(rowid) as blob:
+        while True:
+            chunk = blob.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class ZipStream(io.RawIOBase):
+    """
+    An unseekable file which keeps what is written to it until it is popped,
+    so that a ZIP archive can be streamed as it is written.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        chunks = self.chunks
+        self.chunks = []
+        return chunks
+
+
+def _body(tile):
+    # Packed tiles are memoryviews of the archive, so that looking them up and
+    # caching them copies nothing. WSGI servers must be given bytes, though
+    # (Werkzeug's asserts it), so they are copied once here.
+    if isinstance(tile, memoryview):
+        return tile.tobytes()
+    else:
+        return tile
+
+
+def boundary_from_args(args):
+    return Boundary(float(args.get('left', -180)),
+                    float(args.get('bottom', -85)),
+                    float(args.get('right', 180)),
+                    float(args.get('top', 85)))
+
+
 @app.route('/<name>')
 def serve_map(name):
     return HTML.format(tileset=name)
 
 
+@app.route('/<name>/warm', methods=['POST'])
+def serve_warm(name):
+    if CACHE is None:
+        flask.abort(404)
+
+    args = flask.request.values
+
+    boundary = boundary_from_args(args)
+    zoom_levels = range(int(args['min_zoom']), int(args['max_zoom']) + 1)
+
+    loaded, skipped = warm_cache(name, boundary, zoom_levels,
+                                 app.config['WARM_MAX_TILES'])
+
+    return flask.jsonify(tiles=loaded, skipped=skipped)
+
+
+@app.route('/<name>/<int:zoom>/bbox')
+def serve_bbox(name, zoom):
+    boundary = boundary_from_args(flask.request.values)
+
+    count = count_tiles(name, zoom, boundary)
+    if count == 0:
+        flask.abort(404)
+    elif count > app.config['BBOX_MAX_TILES']:
+        flask.abort(400)
+
+    def generate():
+        formats = {}
+        stream = ZipStream()
+
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+            for row, col, tile, tileset in find_tiles(name, zoom, boundary):
+                if tileset not in formats:
+                    formats[tileset] = tileset.format
+
+                path = '{}/{}/{}.{}'.format(zoom, row, col, formats[tileset])
+                archive.writestr(path, tile)
+                yield from stream.pop()
+
+        yield from stream.pop()
+
+    return flask.Response(generate(), mimetype='application/zip')
+
+
 @app.route('/<name>/<int:zoom>/<int:row>/<int:col>')
 def serve_tile(name, zoom, row, col):
+    if PREFETCHER is not None:
+        PREFETCHER.request(name, zoom, row, col)
+
+    if CACHE is not None:
+        cached = CACHE.get((name, zoom, row, col))
+        if cached is not None:
+            tile, mime_type = cached
+            return flask.Response(_body(tile), mimetype=mime_type)
+
+    inline_limit = None
+    if BLOB_STREAMING:
+        inline_limit = app.config['TILE_STREAM_THRESHOLD']
+
     try:
-        tile, tileset = find_tile(name, zoom, row, col)
+        (rowid, length, tile), tileset = \
+            locate_tile(name, zoom, row, col, inline_limit)
     except KeyError:
         flask.abort(404)
-    else:
-        stream = io.BytesIO(tile)
-        return flask.send_file(stream, mimetype=tileset.mime_type)
+
+    if tile is None:
+        chunk_size = app.config['TILE_STREAM_CHUNK_SIZE']
+        tile = stream_blob(tileset, rowid, chunk_size)
+    elif CACHE is not None:
+        CACHE.put((name, zoom, row, col), tile, tileset.mime_type)
+
+    response = flask.Response(_body(tile), mimetype=tileset.mime_type)
+    response.headers['Content-Length'] = str(length)
+    return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from cartographer.boundaries import Boundary
+from cartographer.importers import Importer, FallbackImporter
+from cartographer.mbtiles import Tileset
+from cartographer.origin import FakeOrigin
+from cartographer.sharding import ShardedTileset
+
+
+class WindowImporter(Importer):
+    """Tracks how many tiles have been queued but not yet written."""
+
+    def __init__(self, url):
+        super().__init__(url)
+        self.queued = 0
+        self.stored = 0
+        self.max_in_flight = 0
+
+    def missing_tiles(self, tileset, zoom, boundary=None):
+        for key in super().missing_tiles(tileset, zoom, boundary):
+            self.queued += 1
+            self.max_in_flight = max(self.max_in_flight,
+                                     self.queued - self.stored)
+            yield key
+
+    def store_tile(self, tileset, key, content):
+        super().store_tile(tileset, key, content)
+        self.stored += 1
+
+
+class ImporterTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        filename = os.path.join(directory.name, 'test.mbtiles')
+        self.tileset = Tileset(filename, create=True)
+        self.tileset.boundary = Boundary(-170, -80, 170, 80)
+
+    def serve(self, origin):
+        server = origin.make_server()
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://{}:{}/{{zoom}}/{{col}}/{{nrow}}.png' \
+            .format(*server.server_address)
+
+
+class TestImporter(ImporterTestCase):
+    def test(self):
+        importer = Importer(self.serve(FakeOrigin('{zoom}/{col}/{nrow}.png')))
+        expected = len(list(importer.missing_tiles(self.tileset, 1)))
+        importer(self.tileset, 1)
+        self.assertEqual(self.tileset.tiles.count(zoom=1), expected)
+        self.assertEqual(list(importer.missing_tiles(self.tileset, 1)), [])
+
+    def test_workers(self):
+        importer = Importer(self.serve(FakeOrigin('{zoom}/{col}/{nrow}.png')))
+        expected = len(list(importer.missing_tiles(self.tileset, 2)))
+        importer(self.tileset, 2, workers=4)
+        self.assertEqual(self.tileset.tiles.count(zoom=2), expected)
+
+    def test_workers_window(self):
+        importer = WindowImporter(
+            self.serve(FakeOrigin('{zoom}/{col}/{nrow}.png'))
+        )
+        importer(self.tileset, 3, workers=2)
+        self.assertGreater(importer.stored, 0)
+        self.assertLessEqual(importer.max_in_flight, 2 * 4)
+
+    def test_workers_sharded(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        tileset = ShardedTileset(os.path.join(directory.name, 'test'),
+                                 create=True, shard_zoom=1)
+        tileset.boundary = self.tileset.boundary
+
+        importer = Importer(self.serve(FakeOrigin('{zoom}/{col}/{nrow}.png')))
+        expected = len(list(importer.missing_tiles(tileset, 2)))
+        importer(tileset, 2, workers=4)
+
+        self.assertEqual(tileset.tiles.count(zoom=2), expected)
+        self.assertEqual(len(tileset.shard_names()), 5)
+
+    def test_failure(self):
+        origin = FakeOrigin('{zoom}/{col}/{nrow}.png', error_rate=1)
+        importer = Importer(self.serve(origin))
+        importer(self.tileset, 1)
+        self.assertEqual(self.tileset.tiles.count(zoom=1), 0)
+
+
+class TestFallbackImporter(ImporterTestCase):
+    def test(self):
+        primary = self.serve(FakeOrigin('{zoom}/{col}/{nrow}.png',
+                                        error_rate=0.5, seed=1))
+        secondary = self.serve(FakeOrigin('{zoom}/{col}/{nrow}.png'))
+
+        importer = FallbackImporter([Importer(primary), Importer(secondary)])
+        expected = len(list(importer.missing_tiles(self.tileset, 2)))
+        importer(self.tileset, 2, workers=4)
+
+        self.assertEqual(self.tileset.tiles.count(zoom=2), expected)
+
+        counts = self.tileset.sources.counts()
+        self.assertEqual(set(counts), {primary, secondary})
+        self.assertEqual(sum(counts.values()), expected)
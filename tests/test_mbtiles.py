@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+
+from cartographer.mbtiles import Tileset
+
+
+class TestTileset(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'test.mbtiles')
+
+        self.tileset = Tileset(self.filename, create=True)
+        self.tileset.name = 'test'
+        self.tileset.format = 'png'
+
+    def test_missing(self):
+        with self.assertRaises(ValueError):
+            Tileset(self.filename + '.missing')
+
+    def test_metadata(self):
+        self.assertEqual(self.tileset.name, 'test')
+        self.assertEqual(self.tileset.mime_type, 'image/png')
+
+    def test_tiles(self):
+        self.tileset[(1, 0, 1)] = b'a'
+        self.tileset[(1, 0, 1)] = b'b'
+
+        self.assertIn((1, 0, 1), self.tileset)
+        self.assertEqual(self.tileset[(1, 0, 1)], b'b')
+        self.assertEqual(self.tileset.tiles.count(zoom=1), 1)
+        self.assertEqual(self.tileset.zoom_levels, [1])
+
+        del self.tileset[(1, 0, 1)]
+
+        with self.assertRaises(KeyError):
+            self.tileset[(1, 0, 1)]
+
+    def test_get_many(self):
+        self.tileset[(1, 0, 1)] = b'a'
+        self.tileset[(1, 1, 0)] = b'b'
+
+        keys = [(1, 1, 0), (2, 0, 0), (1, 0, 1)]
+        self.assertEqual(list(self.tileset.tiles.get_many(keys, 2)), [
+            ((1, 1, 0), b'b'), ((2, 0, 0), None), ((1, 0, 1), b'a')
+        ])
+
+    def test_get_many_plan(self):
+        cursor = self.tileset.db.execute(
+            'EXPLAIN QUERY PLAN ' + self.tileset.tiles._get_many_sql(2),
+            [0, 0, 0, 1, 0, 0]
+        )
+        plan = ' '.join(row[-1] for row in cursor)
+
+        self.assertIn('SEARCH tiles USING INDEX tile_index', plan)
+        self.assertNotIn('SCAN tiles', plan)
+
+    def test_get_range(self):
+        for col in range(4):
+            for row in range(4):
+                self.tileset[(2, col, row)] = bytes([col, row])
+
+        tiles = list(self.tileset.tiles.get_range(2, range(1, 3),
+                                                  range(2, 4)))
+        self.assertEqual(tiles, [
+            (2, 1, 2, b'\x01\x02'), (2, 1, 3, b'\x01\x03'),
+            (2, 2, 2, b'\x02\x02'), (2, 2, 3, b'\x02\x03'),
+        ])
+        self.assertEqual(
+            self.tileset.tiles.count_range(2, range(1, 3), range(2, 4)), 4
+        )
+
+    def test_zoom_levels(self):
+        self.tileset.metadata['minzoom'] = 0
+        self.tileset.metadata['maxzoom'] = 1
+
+        for zoom in [5, 0, 1]:
+            self.tileset[(zoom, 0, 0)] = b'a'
+
+        self.assertEqual(self.tileset.zoom_levels, [0, 1, 5])
+
+        self.tileset.db.execute('DROP INDEX tile_index')
+        self.assertEqual(self.tileset.zoom_levels, [0, 1, 5])
+
+    def test_upgrade(self):
+        self.tileset.db.execute('DROP INDEX tile_index')
+
+        tileset = Tileset(self.filename, upgrade=True)
+        cursor = tileset.db.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = 'tile_index'"
+        )
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class TestTilesetWal(TestTileset):
+    def setUp(self):
+        super().setUp()
+        self.tileset.enable_wal()
+
+    def test_journal_mode(self):
+        self.assertEqual(self.tileset.journal_mode, 'wal')
+        self.assertEqual(Tileset(self.filename).journal_mode, 'wal')
+
+    def test_read_while_writing(self):
+        self.tileset[(1, 0, 0)] = b'a'
+
+        self.tileset.db.execute('BEGIN IMMEDIATE')
+        self.tileset.db.execute(
+            'INSERT INTO tiles VALUES (1, 1, 1, ?)', (b'b',)
+        )
+
+        reader = Tileset(self.filename, timeout=0)
+        self.assertEqual(reader[(1, 0, 0)], b'a')
+        self.assertNotIn((1, 1, 1), reader)
+
+        self.tileset.db.commit()
+        self.assertIn((1, 1, 1), reader)
+
+    def test_compact(self):
+        self.tileset[(1, 0, 0)] = b'a'
+        self.tileset.compact(vacuum=True)
+
+        self.assertEqual(os.path.getsize(self.filename + '-wal'), 0)
+        self.assertEqual(self.tileset[(1, 0, 0)], b'a')
@@ -0,0 +1,87 @@
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+from cartographer.origin import compile_pattern, generate_png, \
+    generate_jpeg, FakeOrigin, PNG_SIGNATURE
+
+
+class TestCompilePattern(unittest.TestCase):
+    def test_xyz(self):
+        regex = compile_pattern('http://example.com/{zoom}/{col}/{nrow}.png')
+        match = regex.match('/3/4/5.png')
+        self.assertEqual(match.groupdict(),
+                         {'zoom': '3', 'col': '4', 'nrow': '5'})
+        self.assertIsNone(regex.match('/3/4.png'))
+
+    def test_quad_key(self):
+        regex = compile_pattern('/tiles/r{quad_key}.png?g=1&key={key}')
+        match = regex.match('/tiles/r0123.png')
+        self.assertEqual(match.group('quad_key'), '0123')
+        self.assertIsNone(regex.match('/tiles/r0124.png'))
+
+
+class TestGenerate(unittest.TestCase):
+    def test_png(self):
+        tile = generate_png('a')
+        self.assertTrue(tile.startswith(PNG_SIGNATURE))
+        self.assertEqual(tile, generate_png('a'))
+        self.assertNotEqual(tile, generate_png('b'))
+
+    def test_jpeg(self):
+        tile = generate_jpeg('a')
+        self.assertTrue(tile.startswith(b'\xff\xd8'))
+        self.assertTrue(tile.endswith(b'\xff\xd9'))
+        self.assertNotEqual(tile, generate_jpeg('b'))
+
+
+class TestFakeOrigin(unittest.TestCase):
+    def serve(self, origin):
+        server = origin.make_server()
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://{}:{}'.format(*server.server_address)
+
+    def test_ok(self):
+        origin = FakeOrigin('{zoom}/{col}/{nrow}.png', seed=1)
+        url = self.serve(origin)
+
+        with urllib.request.urlopen(url + '/1/0/1.png') as res:
+            self.assertEqual(res.headers['Content-Type'], 'image/png')
+            self.assertTrue(res.read().startswith(PNG_SIGNATURE))
+
+        self.assertEqual(origin.counts['ok'], 1)
+
+    def test_not_found(self):
+        url = self.serve(FakeOrigin('{zoom}/{col}/{nrow}.png'))
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(url + '/hello')
+
+        self.assertEqual(cm.exception.code, 404)
+
+    def test_throttled(self):
+        url = self.serve(FakeOrigin('{zoom}/{col}/{nrow}.jpg',
+                                    throttle_rate=1))
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(url + '/1/0/1.jpg')
+
+        self.assertEqual(cm.exception.code, 429)
+
+    def test_error(self):
+        url = self.serve(FakeOrigin('{zoom}/{col}/{nrow}.jpg', error_rate=1))
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(url + '/1/0/1.jpg')
+
+        self.assertGreaterEqual(cm.exception.code, 500)
+
+    def test_reset(self):
+        url = self.serve(FakeOrigin('{zoom}/{col}/{nrow}.jpg', reset_rate=1))
+
+        with self.assertRaises((ConnectionError, urllib.error.URLError)):
+            urllib.request.urlopen(url + '/1/0/1.jpg')
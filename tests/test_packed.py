@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+from cartographer.mbtiles import open_tileset, Tileset
+from cartographer.packed import pack, split_tile_key, tile_key, \
+    PackedTileset
+
+
+class TestTileKey(unittest.TestCase):
+    def test(self):
+        for key in [(0, 0, 0), (1, 1, 0), (3, 5, 2), (20, 12345, 67890)]:
+            self.assertEqual(split_tile_key(tile_key(*key)), key)
+
+    def test_order(self):
+        keys = [(1, 0, 1), (1, 1, 1), (1, 0, 0), (1, 1, 0), (0, 0, 0)]
+        self.assertEqual(sorted(keys, key=lambda key: tile_key(*key)),
+                         [(0, 0, 0), (1, 0, 1), (1, 1, 1), (1, 0, 0),
+                          (1, 1, 0)])
+
+
+class TestPackedTileset(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        tileset = Tileset(os.path.join(directory.name, 'test.mbtiles'),
+                          create=True)
+        tileset.name = 'test'
+        tileset.format = 'jpg'
+        tileset[(0, 0, 0)] = b'root'
+        tileset[(2, 1, 3)] = b'same'
+        tileset[(2, 3, 1)] = b'same'
+        tileset[(2, 0, 0)] = b'other'
+
+        self.filename = os.path.join(directory.name, 'test.pack')
+        for col in range(8):
+            for row in range(8):
+                tileset[(3, col, row)] = bytes([col, row])
+
+        self.assertEqual(pack(tileset, self.filename), (68, 67))
+
+        self.tileset = open_tileset(self.filename)
+
+    def test_metadata(self):
+        self.assertIsInstance(self.tileset, PackedTileset)
+        self.assertEqual(self.tileset.name, 'test')
+        self.assertEqual(self.tileset.mime_type, 'image/jpeg')
+        self.assertEqual(self.tileset.zoom_levels, [0, 2, 3])
+
+    def test_tiles(self):
+        self.assertEqual(self.tileset[(0, 0, 0)], b'root')
+        self.assertEqual(self.tileset[(2, 1, 3)], b'same')
+        self.assertEqual(self.tileset[(2, 3, 1)], b'same')
+        self.assertIn((2, 0, 0), self.tileset)
+        self.assertNotIn((2, 0, 1), self.tileset)
+
+        with self.assertRaises(KeyError):
+            self.tileset[(5, 0, 0)]
+
+        self.assertEqual(self.tileset.tiles.count(zoom=2), 3)
+        self.assertEqual(len(list(self.tileset)), 68)
+
+    def test_lookup(self):
+        index, length, data = self.tileset.tiles.lookup((2, 0, 0))
+        self.assertIsInstance(data, memoryview)
+        self.assertEqual((length, data), (5, b'other'))
+
+        index, length, data = self.tileset.tiles.lookup((2, 0, 0), 2)
+        self.assertIsNone(data)
+
+        with self.tileset.tiles.open_blob(index) as blob:
+            self.assertEqual(blob.read(2), b'ot')
+            self.assertEqual(blob.read(), b'her')
+
+    def test_get_range(self):
+        tiles = list(self.tileset.tiles.get_range(3, range(2, 5),
+                                                  range(3, 7)))
+        self.assertEqual(tiles, [
+            (3, col, row, bytes([col, row]))
+            for col in range(2, 5) for row in range(3, 7)
+        ])
+        self.assertEqual(
+            self.tileset.tiles.count_range(3, range(2, 5), range(3, 7)), 12
+        )
+
+    def test_get_many(self):
+        keys = [(2, 0, 0), (2, 0, 1)]
+        self.assertEqual(list(self.tileset.tiles.get_many(keys)), [
+            ((2, 0, 0), b'other'), ((2, 0, 1), None)
+        ])
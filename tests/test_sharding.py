@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from cartographer.mbtiles import open_tileset
+from cartographer.sharding import quadkey, ShardedTileset
+
+
+class TestQuadkey(unittest.TestCase):
+    def test(self):
+        self.assertEqual(quadkey(0, 0, 0), '')
+        self.assertEqual(quadkey(1, 0, 1), '0')
+        self.assertEqual(quadkey(1, 1, 0), '3')
+        self.assertEqual(quadkey(3, 3, 2), '213')
+
+
+class TestShardedTileset(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = os.path.join(directory.name, 'test.mbtiles')
+
+        self.tileset = ShardedTileset(self.directory, create=True,
+                                      shard_zoom=1)
+        self.tileset.name = 'test'
+        self.tileset.format = 'png'
+
+    def test_metadata(self):
+        tileset = open_tileset(self.directory)
+        self.assertIsInstance(tileset, ShardedTileset)
+        self.assertEqual(tileset.name, 'test')
+        self.assertEqual(tileset.shard_zoom, 1)
+
+    def test_create_existing(self):
+        with self.assertRaises(ValueError):
+            ShardedTileset(self.directory, create=True, shard_zoom=2)
+
+        self.assertEqual(open_tileset(self.directory).shard_zoom, 1)
+
+    def test_tiles(self):
+        self.tileset[(0, 0, 0)] = b'a'
+        self.tileset[(2, 0, 0)] = b'b'
+        self.tileset[(2, 3, 3)] = b'c'
+
+        self.assertEqual(self.tileset.shard_names(), ['base', '1', '2'])
+
+        self.assertEqual(self.tileset[(0, 0, 0)], b'a')
+        self.assertEqual(self.tileset[(2, 3, 3)], b'c')
+        self.assertIn((2, 0, 0), self.tileset)
+        self.assertNotIn((2, 0, 3), self.tileset)
+
+        with self.assertRaises(KeyError):
+            self.tileset[(2, 0, 3)]
+
+        self.assertEqual(self.tileset.tiles.count(zoom=2), 2)
+        self.assertEqual(self.tileset.zoom_levels, [0, 2])
+        self.assertEqual(self.tileset.tiles._get_row(3, 2), [3])
+        self.assertEqual(len(list(self.tileset)), 3)
+
+        del self.tileset[(2, 3, 3)]
+        self.assertNotIn((2, 3, 3), self.tileset)
+
+    def test_upgrade(self):
+        self.tileset[(2, 0, 0)] = b'b'
+        self.tileset[(2, 3, 3)] = b'c'
+
+        for name in self.tileset.shard_names():
+            self.tileset.shard(name).db.execute('DROP INDEX tile_index')
+
+        open_tileset(self.directory, upgrade=True)
+
+        for name in self.tileset.shard_names():
+            db = sqlite3.connect(self.tileset.shard(name).filename)
+            self.addCleanup(db.close)
+            cursor = db.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE name = 'tile_index'"
+            )
+            self.assertEqual(cursor.fetchone()[0], 1, name)
+
+    def test_lookup(self):
+        self.tileset[(2, 3, 3)] = b'c'
+
+        rowid, length, data = self.tileset.tiles.lookup((2, 3, 3))
+        self.assertEqual(rowid[0], '1')
+        self.assertEqual((length, data), (1, b'c'))
+
+    def test_wal(self):
+        self.tileset[(2, 3, 3)] = b'c'
+        self.tileset.enable_wal()
+        self.tileset[(2, 0, 0)] = b'b'
+
+        for name in self.tileset.shard_names():
+            self.assertEqual(self.tileset.shard(name).journal_mode, 'wal')
+
+    def test_get_range(self):
+        for col in range(4):
+            for row in range(4):
+                self.tileset[(2, col, row)] = bytes([col, row])
+
+        self.assertEqual(len(self.tileset.shard_names()), 5)
+
+        tiles = list(self.tileset.tiles.get_range(2, range(1, 3),
+                                                  range(1, 3)))
+        self.assertEqual([tile[1:3] for tile in tiles],
+                         [(1, 1), (1, 2), (2, 1), (2, 2)])
+        self.assertEqual(
+            self.tileset.tiles.count_range(2, range(1, 3), range(1, 3)), 4
+        )
+
+        keys = [(2, 3, 3), (2, 0, 0), (3, 0, 0)]
+        self.assertEqual(list(self.tileset.tiles.get_many(keys)), [
+            ((2, 3, 3), b'\x03\x03'), ((2, 0, 0), b'\x00\x00'),
+            ((3, 0, 0), None)
+        ])
+
+    def test_writer(self):
+        with self.tileset.writer(batch_size=3) as writer:
+            for col in range(4):
+                for row in range(4):
+                    writer[(2, col, row)] = bytes([col, row])
+            writer[(0, 0, 0)] = b'a'
+            writer.sources[(0, 0, 0)] = 'http://example.com/'
+
+            self.assertEqual(len(writer.threads), 5)
+
+        self.assertEqual(self.tileset.shard_names(),
+                         ['base', '0', '1', '2', '3'])
+        self.assertEqual(self.tileset.tiles.count(zoom=2), 16)
+        self.assertEqual(self.tileset[(2, 1, 2)], b'\x01\x02')
+        self.assertEqual(self.tileset.sources.counts(),
+                         {'http://example.com/': 1})
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+from cartographer.boundaries import Boundary
+from cartographer.compressors import Compressor
+from cartographer.mbtiles import Tileset
+from cartographer.subset import subset, DedupingCompressor
+
+
+class CountingCompressor(Compressor):
+    def __init__(self):
+        self.calls = 0
+
+    def compress(self, data):
+        self.calls += 1
+        return data[:1]
+
+
+class TestDedupingCompressor(unittest.TestCase):
+    def test(self):
+        compressor = CountingCompressor()
+        deduping = DedupingCompressor(compressor, max_size=1)
+
+        self.assertEqual(deduping.compress(b'aa'), b'a')
+        self.assertEqual(deduping.compress(b'aa'), b'a')
+        self.assertEqual(compressor.calls, 1)
+
+        deduping.compress(b'bb')
+        deduping.compress(b'aa')
+        self.assertEqual(compressor.calls, 3)
+
+
+class TestSubset(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        self.tileset = Tileset(os.path.join(self.directory, 'a.mbtiles'),
+                               create=True)
+        self.tileset.name = 'a'
+        self.tileset.format = 'png'
+        self.tileset.boundary = Boundary(-180, -85, 180, 85)
+
+        for zoom in range(4):
+            for col in range(2 ** zoom):
+                for row in range(2 ** zoom):
+                    self.tileset[(zoom, col, row)] = b'tile'
+
+    def test(self):
+        filename = os.path.join(self.directory, 'b.mbtiles')
+        boundary = Boundary(1, 1, 89, 66)
+
+        count = subset(self.tileset, filename, boundary, range(1, 4))
+
+        target = Tileset(filename)
+        self.assertEqual(count, 1 + 1 + 4)
+        self.assertEqual(target.name, 'a')
+        self.assertEqual(target.bounds, '1,1,89,66')
+        self.assertEqual(target.zoom_levels, [1, 2, 3])
+        self.assertEqual(target.tiles.count(zoom=3), 4)
+        self.assertIn((3, 4, 4), target)
+        self.assertIn((3, 5, 5), target)
+
+    def test_no_zoom_levels(self):
+        filename = os.path.join(self.directory, 'b.mbtiles')
+
+        with self.assertRaises(ValueError):
+            subset(self.tileset, filename, self.tileset.boundary, range(3, 2))
+
+        self.assertFalse(os.path.exists(filename))
+
+    def test_exists(self):
+        with self.assertRaises(ValueError):
+            subset(self.tileset, self.tileset.filename, self.tileset.boundary,
+                   [0])
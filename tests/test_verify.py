@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+
+from cartographer.mbtiles import Tileset
+from cartographer.origin import generate_png, generate_jpeg
+from cartographer.sharding import ShardedTileset
+from cartographer.verify import check_png, check_jpeg, check_tile, \
+    delete_tiles, TileError, Verifier
+
+
+class TestCheckPng(unittest.TestCase):
+    def test_ok(self):
+        check_png(generate_png('a'))
+
+    def test_truncated(self):
+        tile = generate_png('a')
+
+        with self.assertRaises(TileError):
+            check_png(tile[:len(tile) // 2])
+
+        with self.assertRaises(TileError):
+            check_png(tile[:-12])
+
+    def test_corrupt(self):
+        tile = bytearray(generate_png('a'))
+        tile[40] ^= 0xff
+
+        with self.assertRaises(TileError):
+            check_png(bytes(tile))
+
+
+class TestCheckJpeg(unittest.TestCase):
+    def test_ok(self):
+        check_jpeg(generate_jpeg('a'))
+
+    def test_truncated(self):
+        tile = generate_jpeg('a')
+
+        with self.assertRaises(TileError):
+            check_jpeg(tile[:-2])
+
+        with self.assertRaises(TileError):
+            check_jpeg(tile[:20])
+
+
+class TestCheckTile(unittest.TestCase):
+    def test(self):
+        tile = generate_png('a')
+
+        self.assertIsNone(check_tile(tile, 'png'))
+        self.assertEqual(check_tile(b'', 'png'), 'empty')
+        self.assertEqual(check_tile(b'<html>Not Found</html>', 'png'),
+                         'error page')
+        self.assertEqual(check_tile(tile, 'png', min_size=len(tile) + 1),
+                         'too small')
+
+        digest = hashlib.sha1(tile).hexdigest()
+        self.assertEqual(check_tile(tile, 'png', bad_digests={digest}),
+                         'known bad tile')
+
+
+class TestVerifier(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        self.tileset = Tileset(os.path.join(directory.name, 'a.mbtiles'),
+                               create=True)
+        self.tileset.format = 'png'
+
+        for col in range(4):
+            for row in range(4):
+                self.tileset[(2, col, row)] = generate_png('a')
+
+        self.tileset[(2, 0, 0)] = b''
+        self.tileset[(2, 3, 3)] = generate_png('b')[:100]
+
+    def test(self):
+        verifier = Verifier(self.tileset, processes=2, batch_size=3)
+        problems = verifier.run(delete_tiles)
+
+        self.assertEqual(verifier.count, 16)
+        self.assertEqual(problems, {'empty': 1, 'truncated': 1})
+        self.assertNotIn((2, 0, 0), self.tileset)
+        self.assertNotIn((2, 3, 3), self.tileset)
+        self.assertEqual(self.tileset.tiles.count(zoom=2), 14)
+        self.assertEqual(self.tileset.journal_mode, 'wal')
+        self.assertFalse(os.path.exists(verifier.checkpoint))
+
+    def test_too_small(self):
+        verifier = Verifier(self.tileset, processes=1, min_size=10000)
+        problems = verifier.run(delete_tiles)
+
+        self.assertEqual(problems, {'empty': 1, 'truncated': 1,
+                                    'too small': 14})
+        self.assertEqual(self.tileset.tiles.count(zoom=2), 14)
+
+    def test_resume(self):
+        verifier = Verifier(self.tileset, processes=1, batch_size=3)
+
+        with open(verifier.checkpoint, 'w') as file:
+            json.dump({'rowid': 15, 'count': 15, 'problems': {'empty': 1}},
+                      file)
+
+        problems = verifier.run()
+
+        self.assertEqual(verifier.count, 16)
+        self.assertEqual(problems, {'empty': 1, 'truncated': 1})
+        self.assertIn((2, 3, 3), self.tileset)
+
+    def test_shard(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        tileset = ShardedTileset(os.path.join(directory.name, 'b'),
+                                 create=True, shard_zoom=1)
+        tileset.format = 'png'
+        tileset[(0, 0, 0)] = generate_png('a')
+        tileset[(2, 3, 3)] = generate_png('b')[:100]
+
+        problems = {}
+        for name in tileset.shard_names():
+            verifier = Verifier(tileset.shard(name), tileset.format,
+                                processes=1)
+            problems[name] = verifier.run()
+
+        self.assertEqual(problems, {'base': {}, '1': {'truncated': 1}})
@@ -0,0 +1,237 @@
+import io
+import os
+import tempfile
+import threading
+import unittest
+import zipfile
+
+from cartographer import web
+from cartographer.mbtiles import Tileset
+from cartographer.packed import pack
+from cartographer.sharding import ShardedTileset
+from cartographer.web import TileCache, Prefetcher
+
+
+class TestTileCache(unittest.TestCase):
+    def test(self):
+        cache = TileCache(4)
+        cache.put('a', b'aa', 'image/png')
+        cache.put('b', b'bb', 'image/png')
+
+        self.assertEqual(cache.get('a'), (b'aa', 'image/png'))
+
+        cache.put('c', b'cc', 'image/png')
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.size, 4)
+
+    def test_too_large(self):
+        cache = TileCache(4)
+        cache.put('a', b'aaaaa', 'image/png')
+        self.assertNotIn('a', cache)
+
+
+class TestPrefetcher(unittest.TestCase):
+    def test_neighbours(self):
+        neighbours = set(Prefetcher.neighbours(2, 0, 0))
+        self.assertEqual(neighbours, {
+            (2, 3, 0), (2, 3, 1), (2, 0, 1), (2, 1, 0), (2, 1, 1), (1, 0, 0)
+        })
+
+    def test_neighbours_root(self):
+        self.assertEqual(list(Prefetcher.neighbours(0, 0, 0)), [])
+
+
+class TestWarm(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        tileset = Tileset(os.path.join(directory.name, 'a.mbtiles'),
+                          create=True)
+        tileset.name = 'a'
+        tileset.format = 'png'
+        for zoom in range(3):
+            for col in range(2 ** zoom):
+                for row in range(2 ** zoom):
+                    tileset[(zoom, col, row)] = b'tile'
+
+        web.app.config['TILES_PATH'] = directory.name
+        web.load_tiles()
+        web.READY = True
+        web.CACHE = TileCache(1024)
+
+        self.addCleanup(web.MAPS.clear)
+        self.addCleanup(setattr, web, 'READY', False)
+        self.addCleanup(setattr, web, 'CACHE', None)
+
+        self.client = web.app.test_client()
+
+    def warm(self, max_tiles):
+        web.app.config['WARM_MAX_TILES'] = max_tiles
+        self.addCleanup(web.app.config.__setitem__, 'WARM_MAX_TILES', 16384)
+
+        response = self.client.post('/a/warm', data={
+            'min_zoom': 0, 'max_zoom': 2, 'left': -180, 'bottom': -85,
+            'right': 180, 'top': 85,
+        })
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test(self):
+        self.assertEqual(self.warm(5), {'tiles': 5, 'skipped': 16})
+        self.assertIn(('a', 1, 1, 0), web.CACHE)
+        self.assertNotIn(('a', 2, 0, 0), web.CACHE)
+
+    def test_cache_full(self):
+        web.CACHE = TileCache(10)
+        self.assertEqual(self.warm(100), {'tiles': 2, 'skipped': 19})
+
+    def test_serve_cached(self):
+        web.CACHE.put(('a', 0, 0, 0), b'cached', 'image/png')
+
+        response = self.client.get('/a/0/0/0')
+        self.assertEqual(response.data, b'cached')
+
+        response = self.client.get('/a/1/0/0')
+        self.assertEqual(response.data, b'tile')
+        self.assertEqual(web.CACHE.get(('a', 1, 0, 0)),
+                         (b'tile', 'image/png'))
+
+
+class TestLoadTiles(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        tileset = Tileset(os.path.join(self.directory, 'a.mbtiles'),
+                          create=True)
+        tileset.name = 'a'
+        tileset.format = 'png'
+        tileset[(1, 0, 0)] = b'a'
+
+        web.app.config['TILES_PATH'] = self.directory
+        self.addCleanup(web.MAPS.clear)
+
+    def test_cache(self):
+        web.load_tiles()
+        self.assertTrue(web.MAPS[('a', 1)][0].is_open)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory, '.cartographer-cache.json')
+        ))
+
+        web.MAPS.clear()
+        web.load_tiles()
+
+        tileset = web.MAPS[('a', 1)][0]
+        self.assertFalse(tileset.is_open)
+        self.assertEqual(tileset[(1, 0, 0)], b'a')
+        self.assertEqual(tileset.mime_type, 'image/png')
+
+    def test_cache_wal(self):
+        tileset = Tileset(os.path.join(self.directory, 'a.mbtiles'),
+                          wal=True)
+        self.addCleanup(tileset.db.close)
+
+        web.load_tiles()
+        web.MAPS.clear()
+
+        tileset[(2, 0, 0)] = b'b'
+        web.load_tiles()
+
+        self.assertIn(('a', 2), web.MAPS)
+
+    def test_bbox(self):
+        web.load_tiles()
+        web.READY = True
+        self.addCleanup(setattr, web, 'READY', False)
+
+        client = web.app.test_client()
+
+        response = client.get('/a/1/bbox?left=-180&bottom=-85&right=0&top=0')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['1/0/1.png'])
+        self.assertEqual(archive.read('1/0/1.png'), b'a')
+
+        response = client.get('/a/1/bbox?left=0&bottom=0&right=180&top=85')
+        self.assertEqual(response.status_code, 404)
+
+    def test_bbox_too_many(self):
+        web.load_tiles()
+        web.READY = True
+        self.addCleanup(setattr, web, 'READY', False)
+
+        web.app.config['BBOX_MAX_TILES'] = 0
+        self.addCleanup(web.app.config.__setitem__, 'BBOX_MAX_TILES', 4096)
+
+        response = web.app.test_client().get('/a/1/bbox')
+        self.assertEqual(response.status_code, 400)
+
+    def test_threads(self):
+        web.load_tiles()
+        web.READY = True
+        self.addCleanup(setattr, web, 'READY', False)
+
+        client = web.app.test_client()
+        responses = []
+        opened = []
+
+        def request():
+            responses.append(client.get('/a/1/0/1'))
+            opened.append(web.MAPS[('a', 1)][0].tileset)
+
+        for i in range(2):
+            thread = threading.Thread(target=request)
+            thread.start()
+            thread.join()
+
+        self.assertEqual([response.status_code for response in responses],
+                         [200, 200])
+        self.assertEqual(responses[1].data, b'a')
+
+        # The connection is reused by later requests.
+        self.assertIs(opened[0], opened[1])
+
+    def test_sharded(self):
+        tileset = ShardedTileset(os.path.join(self.directory, 'planet'),
+                                 create=True, shard_zoom=1)
+        tileset.name = 'planet'
+        tileset.format = 'png'
+        tileset[(2, 1, 1)] = b'b'
+
+        web.load_tiles()
+        web.READY = True
+        self.addCleanup(setattr, web, 'READY', False)
+
+        response = web.app.test_client().get('/planet/2/1/2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'b')
+
+    def test_packed(self):
+        tileset = Tileset(os.path.join(self.directory, 'b.tmp'), create=True)
+        tileset.name = 'b'
+        tileset.format = 'png'
+        tileset[(1, 0, 0)] = b'packed'
+        pack(tileset, os.path.join(self.directory, 'b.pack'))
+
+        web.load_tiles()
+        web.READY = True
+        web.CACHE = TileCache(1024)
+        self.addCleanup(setattr, web, 'READY', False)
+        self.addCleanup(setattr, web, 'CACHE', None)
+
+        client = web.app.test_client()
+
+        for i in range(2):
+            response = client.get('/b/1/0/1')
+            self.assertEqual(response.data, b'packed')
+            self.assertEqual(response.headers['Content-Length'], '6')
+
+        tile, _ = web.CACHE.get(('b', 1, 0, 1))
+        self.assertIsInstance(tile, memoryview)